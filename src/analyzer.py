@@ -0,0 +1,355 @@
+import argparse
+import io
+import json
+import os
+import warnings
+
+import numpy as np
+
+from platform_code import logger
+
+# Result files are read in chunks of this many bytes, binary logs in this many records
+CHUNK_BYTES = 64 * 1024 * 1024
+CHUNK_RECORDS = 4 * 1024 * 1024
+
+FAILURE_LINE = b"No product found"
+# Failed iterations in domain_app.csv carry no time, the domain sleeps at most this long before retrying
+FAILURE_DELAY = 1.0
+
+# Log-spaced latency buckets from 1 microsecond to 1000 seconds, about 1% wide
+LATENCY_EDGES = np.logspace(-6, 3, 2073)
+
+# Same layout as logger.RECORD
+LOG_RECORD = np.dtype([("timestamp", ">f8"), ("domain", ">u4"), ("message", ">u4")])
+# Domain and message pairs are counted in a dense array up to this many possible pairs, in a dict beyond
+DENSE_PAIRS_MAX = 1 << 24
+
+def _grow(array, size):
+    if len(array) >= size:
+        return array
+    return np.concatenate((array, np.zeros(size - len(array), dtype=array.dtype)))
+
+class RunStats:
+    def __init__(self, label, window=10.0, burst=3):
+        self.label = label
+        self.window = window
+        self.burst = burst
+        self.attempts = 0
+        self.failures = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.duration = 0.0
+        self.buckets = np.zeros(len(LATENCY_EDGES) + 1, dtype=np.int64)
+        # Per window: successes, failures and summed success latency
+        self.window_successes = np.zeros(0, dtype=np.int64)
+        self.window_failures = np.zeros(0, dtype=np.int64)
+        self.window_latency = np.zeros(0, dtype=np.float64)
+        # Failure bursts, the open run is carried across chunks
+        self.bursts = 0
+        self.longest_burst = 0
+        self._open_run = 0
+
+    def add(self, times, latencies, ok):
+        if len(ok) == 0:
+            return
+        successes = latencies[ok]
+        self.attempts += len(ok)
+        self.failures += len(ok) - len(successes)
+        if len(successes):
+            self.total += float(successes.sum())
+            self.max = max(self.max, float(successes.max()))
+            self.buckets += np.bincount(np.searchsorted(LATENCY_EDGES, successes),
+                                        minlength=len(self.buckets))
+        self.duration = max(self.duration, float(times.max()))
+
+        windows = (times // self.window).astype(np.int64)
+        size = int(windows.max()) + 1
+        self.window_successes = _grow(self.window_successes, size)
+        self.window_failures = _grow(self.window_failures, size)
+        self.window_latency = _grow(self.window_latency, size)
+        self.window_successes[:size] += np.bincount(windows[ok], minlength=size)
+        self.window_failures[:size] += np.bincount(windows[~ok], minlength=size)
+        self.window_latency[:size] += np.bincount(windows[ok], weights=successes, minlength=size)
+
+        self._add_bursts(~ok)
+
+    def _add_bursts(self, failed):
+        edges = np.diff(np.concatenate(([0], failed.view(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        lengths = np.flatnonzero(edges == -1) - starts
+        if self._open_run:
+            if failed[0]:
+                lengths[0] += self._open_run
+            else:
+                self._close_runs(np.array([self._open_run]))
+            self._open_run = 0
+        if failed[-1]:
+            self._open_run = int(lengths[-1])
+            lengths = lengths[:-1]
+        self._close_runs(lengths)
+
+    def _close_runs(self, lengths):
+        if len(lengths):
+            self.bursts += int(np.count_nonzero(lengths >= self.burst))
+            self.longest_burst = max(self.longest_burst, int(lengths.max()))
+
+    def finish(self):
+        if self._open_run:
+            self._close_runs(np.array([self._open_run]))
+            self._open_run = 0
+        return self
+
+    def percentile(self, percentile):
+        count = self.attempts - self.failures
+        if count == 0:
+            return 0.0
+        target = max(1, int(round(percentile / 100 * count)))
+        index = int(np.searchsorted(np.cumsum(self.buckets), target))
+        # Upper bucket edge, so percentiles never understate latency
+        return min(float(LATENCY_EDGES[min(index, len(LATENCY_EDGES) - 1)]), self.max)
+
+    def summary(self):
+        successes = self.attempts - self.failures
+        return {
+            "attempts": self.attempts,
+            "successes": successes,
+            "failures": self.failures,
+            "failure_percentage": self.failures / self.attempts * 100 if self.attempts else 0.0,
+            "mean": self.total / successes if successes else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "throughput": successes / self.duration if self.duration > 0 else 0.0,
+            "bursts": self.bursts,
+            "longest_burst": self.longest_burst,
+        }
+
+    def series(self):
+        # Throughput and mean latency per window over the run
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(self.window_successes > 0, self.window_latency / self.window_successes, 0.0)
+        return {
+            "window": self.window,
+            "start": (np.arange(len(mean)) * self.window).tolist(),
+            "throughput": (self.window_successes / self.window).tolist(),
+            "failures": self.window_failures.tolist(),
+            "mean_latency": mean.tolist(),
+        }
+
+'''
+Result files
+=========================
+'''
+def _iter_lines(path, partial=True):
+    # Whole lines only, a partial last line is carried over to the next chunk. Without partial, a
+    # last line the writer is still appending is left out
+    with open(path, "rb") as f:
+        rest = b""
+        while True:
+            chunk = f.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind(b"\n") + 1
+            rest = chunk[end:]
+            if end:
+                yield chunk[:end]
+        if rest and partial:
+            yield rest
+
+def _load_columns(chunk, dtype=np.float64, usecols=None, skiprows=0, ndmin=2):
+    # NumPy's C parser reads the chunk as it is, blank lines and // comments are skipped
+    with warnings.catch_warnings():
+        # Blank lines and chunks without rows only warn
+        warnings.simplefilter("ignore", UserWarning)
+        return np.loadtxt(io.BytesIO(chunk), dtype=dtype, delimiter=";", comments="//",
+                          usecols=usecols, skiprows=skiprows, ndmin=ndmin)
+
+def _analyze_domain_results(path, stats):
+    # domain_app.csv: one elapsed time per iteration, iterations run back to back
+    clock = 0.0
+    for chunk in _iter_lines(path):
+        # Failures become NaN, so the whole chunk parses as one float column
+        latencies = _load_columns(chunk.replace(FAILURE_LINE, b"nan"), ndmin=1)
+        ok = ~np.isnan(latencies)
+        latencies[~ok] = 0.0
+        times = clock + np.cumsum(np.where(ok, latencies, FAILURE_DELAY))
+        if len(times):
+            clock = float(times[-1])
+        stats.add(times, latencies, ok)
+    return stats.finish()
+
+def _analyze_load_results(path, stats, operation=None):
+    # Load generator CSV: start;operation;domain;ok;latency;service_time
+    for index, chunk in enumerate(_iter_lines(path)):
+        skiprows = 1 if index == 0 else 0
+        rows = _load_columns(chunk, usecols=(0, 3, 4), skiprows=skiprows)
+        if len(rows) == 0:
+            continue
+        if operation is not None:
+            operations = _load_columns(chunk, dtype="S", usecols=1, skiprows=skiprows, ndmin=1)
+            rows = rows[operations == operation.encode()]
+        times = rows[:, 0]
+        latencies = rows[:, 2]
+        ok = rows[:, 1] == 1
+        stats.add(times + latencies, latencies, ok)
+    return stats.finish()
+
+def _is_load_results(path):
+    with open(path, "rb") as f:
+        return f.readline().startswith(b"start;operation")
+
+def analyze_run(path, label=None, window=10.0, burst=3, operation=None):
+    stats = RunStats(label or os.path.basename(os.path.dirname(path)) or path, window, burst)
+    if _is_load_results(path):
+        return _analyze_load_results(path, stats, operation)
+    return _analyze_domain_results(path, stats)
+
+'''
+Platform logs
+=========================
+'''
+def analyze_binary_log(path=logger.BINARY_LOG_PATH, strings_path=logger.STRINGS_PATH, window=10.0):
+    # A record the writer is still appending is left out
+    count = os.path.getsize(path) // LOG_RECORD.itemsize
+    records = np.memmap(path, dtype=LOG_RECORD, mode="r", shape=(count,)) if count else np.zeros(0, LOG_RECORD)
+    strings = logger.read_strings(strings_path)
+    width = len(strings)
+    dense = width * width <= DENSE_PAIRS_MAX
+    pairs = np.zeros(width * width, dtype=np.int64) if dense else {}
+    rate = np.zeros(0, dtype=np.int64)
+    first = float(records["timestamp"][0]) if len(records) else 0.0
+
+    for start in range(0, len(records), CHUNK_RECORDS):
+        chunk = records[start:start + CHUNK_RECORDS]
+        keys = chunk["domain"].astype(np.int64) * width + chunk["message"]
+        if dense:
+            pairs += np.bincount(keys, minlength=len(pairs))
+        else:
+            for key, count in zip(*np.unique(keys, return_counts=True)):
+                pairs[int(key)] = pairs.get(int(key), 0) + int(count)
+        windows = ((chunk["timestamp"] - first) // window).astype(np.int64)
+        size = int(windows.max()) + 1
+        rate = _grow(rate, size)
+        rate[:size] += np.bincount(windows, minlength=size)
+
+    domain_messages = {}
+    counted = ((int(pair), int(pairs[pair])) for pair in np.flatnonzero(pairs)) if dense else pairs.items()
+    for pair, count in counted:
+        domain, message = divmod(pair, width)
+        domain_messages.setdefault(strings[domain], {})[strings[message]] = count
+    return {
+        "records": len(records),
+        "domains": domain_messages,
+        "window": window,
+        "rate": (rate / window).tolist(),
+    }
+
+def analyze_csv_log(path=logger.LOG_PATH, window=10.0):
+    # Timestamps have one second resolution, so windows are counted per distinct second
+    pairs = {}
+    seconds = {}
+    records = 0
+    for chunk in _iter_lines(path, partial=False):
+        rows = _load_columns(chunk, dtype="S", usecols=(0, 1, 2))
+        if len(rows) == 0:
+            continue
+        records += len(rows)
+        keys, counts = np.unique(rows[:, 1:], axis=0, return_counts=True)
+        for (domain, message), count in zip(keys.tolist(), counts.tolist()):
+            pairs[domain, message] = pairs.get((domain, message), 0) + count
+        stamps, counts = np.unique(rows[:, 0], return_counts=True)
+        for stamp, count in zip(stamps.tolist(), counts.tolist()):
+            seconds[stamp] = seconds.get(stamp, 0) + count
+
+    domain_messages = {}
+    for (domain, message), count in pairs.items():
+        domain_messages.setdefault(domain.decode(), {})[message.decode()] = count
+    rate = np.zeros(0, dtype=np.int64)
+    if seconds:
+        stamps = np.array(sorted(seconds), dtype="U")
+        stamps = np.char.replace(stamps, ", ", "T")
+        offsets = (stamps.astype("datetime64[s]") - np.datetime64(stamps[0])).astype(np.int64)
+        rate = np.bincount((offsets // window).astype(np.int64),
+                           weights=[seconds[stamp] for stamp in sorted(seconds)])
+    return {
+        "records": records,
+        "domains": domain_messages,
+        "window": window,
+        "rate": (rate / window).tolist(),
+    }
+
+def analyze_platform_log(window=10.0):
+    if os.path.exists(logger.BINARY_LOG_PATH) and os.path.getsize(logger.BINARY_LOG_PATH) > 0:
+        return analyze_binary_log(window=window)
+    return analyze_csv_log(window=window)
+
+'''
+Output
+=========================
+'''
+def print_comparison(runs):
+    rows = [
+        ("Attempts", "attempts", "{:d}"),
+        ("Failures", "failures", "{:d}"),
+        ("Failure %", "failure_percentage", "{:.2f}"),
+        ("Mean (s)", "mean", "{:.6f}"),
+        ("p50 (s)", "p50", "{:.6f}"),
+        ("p95 (s)", "p95", "{:.6f}"),
+        ("p99 (s)", "p99", "{:.6f}"),
+        ("Max (s)", "max", "{:.6f}"),
+        ("Throughput (/s)", "throughput", "{:.2f}"),
+        ("Failure bursts", "bursts", "{:d}"),
+        ("Longest burst", "longest_burst", "{:d}"),
+    ]
+    summaries = [run.summary() for run in runs]
+    width = max([16] + [len(run.label) + 2 for run in runs])
+    print("".ljust(16) + "".join(run.label.rjust(width) for run in runs))
+    for title, key, fmt in rows:
+        print(title.ljust(16) + "".join(fmt.format(summary[key]).rjust(width) for summary in summaries))
+
+def print_platform_log(analysis):
+    print(f"\n=== Platform log: {analysis['records']} messages ===")
+    for domain, messages in sorted(analysis["domains"].items(), key=lambda x: sum(x[1].values()), reverse=True):
+        print(f"{domain}: {sum(messages.values())} total messages")
+        for message, count in sorted(messages.items(), key=lambda x: x[1], reverse=True):
+            print(f"  - {message}: {count} times")
+    if analysis["rate"]:
+        print(f"Peak rate: {max(analysis['rate']):.2f} messages/s over {analysis['window']}s windows")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare domain_app.csv or load generator results across runs")
+    parser.add_argument("results", nargs="*", help="Result files, one per run")
+    parser.add_argument("--label", action="append", default=[], help="Run label, in the order of the results")
+    parser.add_argument("--window", type=float, default=10.0, help="Window in seconds for throughput and latency over time")
+    parser.add_argument("--burst", type=int, default=3, help="Consecutive failures that count as a failure burst")
+    parser.add_argument("--operation", choices=["consume", "discover"],
+                        help="Only count this operation in load generator results")
+    parser.add_argument("--platform-log", action="store_true", help="Also analyze the platform log")
+    parser.add_argument("--output", help="Write summaries and time series to this JSON file")
+    args = parser.parse_args(argv)
+    if not args.results and not args.platform_log:
+        parser.error("give at least one result file or --platform-log")
+    if len(args.label) > len(args.results):
+        parser.error("more labels than result files")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    labels = args.label + [None] * (len(args.results) - len(args.label))
+    runs = [analyze_run(path, label, args.window, args.burst, args.operation)
+            for path, label in zip(args.results, labels)]
+    if runs:
+        print_comparison(runs)
+
+    platform_log = analyze_platform_log(args.window) if args.platform_log else None
+    if platform_log is not None:
+        print_platform_log(platform_log)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "runs": {run.label: {"summary": run.summary(), "series": run.series()} for run in runs},
+                "platform_log": platform_log,
+            }, f, indent=4)
@@ -1,3 +1,8 @@
+import os
+from collections import Counter
+
+from platform_code import logger
+
 def calculate_average_basic():
     total = 0
     count_success = 0
@@ -30,29 +35,46 @@ def calculate_average_basic():
     else:
         print("No successful retrievals found")
 
-def count_domain_messages():
+def _count_csv_messages():
     domain_messages = {}
-    
+    with open("src/platform_code/log.csv", "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.split(";")
+            if len(parts) < 3:
+                continue
+            
+            domain = parts[1]
+            message = parts[2]
+            
+            if domain not in domain_messages:
+                domain_messages[domain] = {}
+            
+            if message not in domain_messages[domain]:
+                domain_messages[domain][message] = 1
+            else:
+                domain_messages[domain][message] += 1
+    return domain_messages
+
+def _count_binary_messages():
+    # Count by string index first, names are only looked up once per pair
+    pair_counts = Counter(
+        (domain, message) for _, domain, message in logger.iter_binary_records()
+    )
+    strings = logger.read_strings()
+    domain_messages = {}
+    for (domain, message), count in pair_counts.items():
+        domain_messages.setdefault(strings[domain], {})[strings[message]] = count
+    return domain_messages
+
+def count_domain_messages():
     try:
-        with open("src/platform_code/log.csv", "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                parts = line.split(";")
-                if len(parts) < 3:
-                    continue
-                
-                domain = parts[1]
-                message = parts[2]
-                
-                if domain not in domain_messages:
-                    domain_messages[domain] = {}
-                
-                if message not in domain_messages[domain]:
-                    domain_messages[domain][message] = 1
-                else:
-                    domain_messages[domain][message] += 1
+        if os.path.exists(logger.BINARY_LOG_PATH) and os.path.getsize(logger.BINARY_LOG_PATH) > 0:
+            domain_messages = _count_binary_messages()
+        else:
+            domain_messages = _count_csv_messages()
         
         print("\n=== Domain Message Analysis ===")
         for domain, messages in domain_messages.items():
@@ -73,8 +95,10 @@ def count_domain_messages():
         print(f"Error analyzing log file: {e}")
 
 if __name__ == "__main__":
-    domain_server_bool = input("Domain or Plarform? (d/p): ").strip().lower()
+    domain_server_bool = input("Domain, Plarform or export the binary platform log to CSV? (d/p/e): ").strip().lower()
     if domain_server_bool == "d":
         calculate_average_basic()
     elif domain_server_bool == "p":
         count_domain_messages()
+    elif domain_server_bool == "e":
+        logger.export_csv()
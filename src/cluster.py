@@ -0,0 +1,246 @@
+import argparse
+import ipaddress
+import json
+import os
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+from platform_code import gateway
+from platform_code.connection_pool import pool
+from platform_code.instrumentation import Histogram
+
+# The nodes use paths relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULTS = {
+    "domains": 10,
+    "platform_host": "127.0.0.1",
+    "domain_base": "127.0.1.1",
+    "platform_workers": 1,
+    "server_workers": 4,
+    "zero_trust": False,
+    "asyncio": False,
+    "subscribe": False,
+    "view": False,
+    "products": 1,
+    "iterations": 1_000_000,
+    "duration": 60.0,
+    "startup_timeout": 120.0,
+    "output": "src/cluster_run",
+}
+
+PLATFORM_LOGS = ("log.csv", "log.bin", "log.strings")
+
+def _flag(value):
+    return "y" if value else "n"
+
+def _wait_until(condition, timeout, interval=0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return True
+        except Exception:
+            pass
+        time.sleep(interval)
+    return False
+
+class Cluster:
+    # A platform and many domains on one host, every node on its own loopback address and port 9000
+    def __init__(self, settings):
+        self.settings = settings
+        self.output = os.path.join(ROOT, settings["output"])
+        base = ipaddress.ip_address(settings["domain_base"])
+        self.domain_hosts = [str(base + index) for index in range(settings["domains"])]
+        self.platform = None
+        self.domains = {}
+        self._log_files = []
+
+    def _env(self):
+        # Every node allows the others, whatever policy file the repository has
+        policy_path = os.path.join(self.output, "policy.json")
+        with open(policy_path, "w") as f:
+            hosts = [self.settings["platform_host"]] + self.domain_hosts
+            json.dump({"default": "deny", "rules": [{"effect": "allow", "domains": hosts}]}, f, indent=4)
+        env = dict(os.environ)
+        env["DATA_MESH_POLICY"] = policy_path
+        env["DATA_MESH_SERVER_WORKERS"] = str(self.settings["server_workers"])
+        # A fresh token signing secret for every run, shared by all nodes
+        env["DATA_MESH_TOKEN_SECRET"] = secrets.token_hex(32)
+        return env
+
+    def _start(self, name, command, env):
+        directory = os.path.join(self.output, name)
+        os.makedirs(directory, exist_ok=True)
+        log_file = open(os.path.join(directory, "stdout.log"), "w")
+        self._log_files.append(log_file)
+        return subprocess.Popen(
+            [sys.executable] + command, cwd=ROOT, env=env,
+            stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT,
+        )
+
+    def _registered_domains(self):
+        response, payload = pool.request(self.settings["platform_host"], "discover", "")
+        if response != "ok":
+            return 0
+        return len({product[1] for product in json.loads(payload)["products"]})
+
+    def start(self):
+        settings = self.settings
+        shutil.rmtree(self.output, ignore_errors=True)
+        os.makedirs(self.output)
+        env = self._env()
+        start_file = os.path.join(self.output, "start")
+
+        self.platform = self._start("platform", [
+            "src/platform_app.py", "--host", settings["platform_host"],
+            "--zero-trust", _flag(settings["zero_trust"]), "--asyncio", _flag(settings["asyncio"]),
+            "--binary-log", "n", "--primary", "", "--workers", str(settings["platform_workers"]),
+        ], env)
+        if not _wait_until(lambda: pool.request(settings["platform_host"], "discover", "")[0] == "ok", 30):
+            raise RuntimeError("The platform did not start, see platform/stdout.log")
+
+        for host in self.domain_hosts:
+            self.domains[host] = self._start(os.path.join("domains", host), [
+                "src/domain_app.py", "--host", host, "--platform", settings["platform_host"],
+                "--zero-trust", _flag(settings["zero_trust"]), "--asyncio", _flag(settings["asyncio"]),
+                "--subscribe", _flag(settings["subscribe"]), "--view", _flag(settings["view"]),
+                "--products", str(settings["products"]), "--iterations", str(settings["iterations"]),
+                "--start-file", start_file, "--output-dir", os.path.join(self.output, "domains", host),
+            ], env)
+        # Every domain consumes from a complete mesh, so they all start once the last one registered
+        if not _wait_until(lambda: self._registered_domains() == len(self.domain_hosts), settings["startup_timeout"], 0.5):
+            print(f"Only {self._registered_domains()} of {len(self.domain_hosts)} domains registered, starting anyway")
+        open(start_file, "w").close()
+        print(f"Started a platform and {len(self.domain_hosts)} domains, consuming for {settings['duration']} seconds")
+
+    def run(self):
+        deadline = time.monotonic() + self.settings["duration"]
+        while time.monotonic() < deadline:
+            time.sleep(min(1.0, max(deadline - time.monotonic(), 0)))
+            exited = [host for host, process in self.domains.items() if process.poll() is not None]
+            if self.platform.poll() is not None or exited:
+                print(f"Nodes exited early: {['platform'] if self.platform.poll() is not None else []} {exited}")
+                break
+
+    def save_stats(self):
+        # Live counters, gauges and latency histograms of every node that is still running
+        nodes = {"platform": self.settings["platform_host"]}
+        nodes.update({os.path.join("domains", host): host for host in self.domain_hosts})
+        for name, host in nodes.items():
+            stats = gateway.client_stats(host)
+            if stats is not None:
+                with open(os.path.join(self.output, name, "stats.json"), "w") as f:
+                    json.dump(stats, f, indent=4)
+
+    def stop(self):
+        # Interrupted domains flush their results and latency histograms before they exit
+        processes = list(self.domains.values()) + [self.platform]
+        for process in processes:
+            if process is not None and process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            if process is None:
+                continue
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        for log_file in self._log_files:
+            log_file.close()
+        pool.close()
+
+    '''
+    Results
+    ==========================
+    '''
+    def _domain_summary(self, host, combined):
+        directory = os.path.join(self.output, "domains", host)
+        histogram = Histogram()
+        failures = 0
+        try:
+            with open(os.path.join(directory, "domain_app.csv"), "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line == "No product found":
+                        failures += 1
+                    elif line:
+                        histogram.record(float(line))
+        except FileNotFoundError:
+            pass
+        combined.merge(histogram)
+        summary = histogram.summary()
+        summary["failures"] = failures
+        try:
+            with open(os.path.join(directory, "domain_app_latency.json"), "r") as f:
+                summary["phases"] = {phase: peers["all"] for phase, peers in json.load(f).items()}
+        except (FileNotFoundError, ValueError):
+            pass
+        return summary
+
+    def collect(self):
+        for name in PLATFORM_LOGS:
+            path = os.path.join(ROOT, "src", "platform_code", name)
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                shutil.copy(path, os.path.join(self.output, "platform", name))
+
+        combined = Histogram()
+        domains = {host: self._domain_summary(host, combined) for host in self.domain_hosts}
+        total = combined.summary()
+        total["failures"] = sum(summary["failures"] for summary in domains.values())
+        total["throughput"] = total["count"] / self.settings["duration"]
+        results = {"config": self.settings, "total": total, "domains": domains}
+        with open(os.path.join(self.output, "cluster.json"), "w") as f:
+            json.dump(results, f, indent=4)
+        return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a platform and many domains on one host over loopback addresses")
+    parser.add_argument("--config", help="JSON file with any of the settings below, flags take precedence")
+    parser.add_argument("--domains", type=int, help=f"Number of domains (default {DEFAULTS['domains']})")
+    parser.add_argument("--platform-host", help=f"Platform address (default {DEFAULTS['platform_host']})")
+    parser.add_argument("--domain-base", help=f"Address of the first domain, the others follow (default {DEFAULTS['domain_base']})")
+    parser.add_argument("--platform-workers", type=int, help="Platform worker processes (default 1)")
+    parser.add_argument("--server-workers", type=int,
+                        help=f"Request threads per node (default {DEFAULTS['server_workers']})")
+    parser.add_argument("--zero-trust", action="store_const", const=True, help="Run in zero-trust mode")
+    parser.add_argument("--asyncio", action="store_const", const=True, help="Use the asyncio servers")
+    parser.add_argument("--subscribe", action="store_const", const=True, help="Domains subscribe instead of polling")
+    parser.add_argument("--view", action="store_const", const=True, help="Consume every product in the mesh per iteration")
+    parser.add_argument("--products", type=int, help="Data products per domain (default 1)")
+    parser.add_argument("--iterations", type=int, help="Consume iterations per domain")
+    parser.add_argument("--duration", type=float, help=f"Seconds to consume for (default {DEFAULTS['duration']})")
+    parser.add_argument("--startup-timeout", type=float,
+                        help=f"Seconds to wait for every domain to register (default {DEFAULTS['startup_timeout']})")
+    parser.add_argument("--output", help=f"Run directory, relative to the repository (default {DEFAULTS['output']})")
+    args = parser.parse_args(argv)
+
+    settings = dict(DEFAULTS)
+    if args.config:
+        with open(args.config, "r") as f:
+            config = json.load(f)
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            parser.error(f"unknown settings in {args.config}: {', '.join(sorted(unknown))}")
+        settings.update(config)
+    settings.update({key: value for key, value in vars(args).items() if key in DEFAULTS and value is not None})
+    return settings
+
+if __name__ == "__main__":
+    cluster = Cluster(parse_args())
+    try:
+        cluster.start()
+        cluster.run()
+        cluster.save_stats()
+    except KeyboardInterrupt:
+        print("Stopping the cluster...")
+    finally:
+        cluster.stop()
+    results = cluster.collect()
+    print(json.dumps(results["total"], indent=4))
+    print(f"Results in {cluster.output}")
@@ -1,4 +1,10 @@
+import os
 import socket
+import sys
+
+# Shared between the platform and the domains to sign and verify access tokens, zero-trust nodes
+# do not start without it
+TOKEN_SECRET = os.environ.get("DATA_MESH_TOKEN_SECRET")
 
 IP_ADDRESSES = [
     "10.0.3.4",
@@ -10,6 +16,34 @@ IP_ADDRESSES = [
     "localhost"
 ]
 
+# Platform primaries the marketplace is partitioned over, and the read replicas of each primary
+PLATFORM_SHARDS = ["10.0.3.5"]
+PLATFORM_REPLICAS = {}
+
+# Servers handle requests on a fixed number of threads. Requests wait in a queue that holds at most
+# SERVER_QUEUE_SIZE requests, and at most SERVER_DOMAIN_QUEUE_SIZE of them from one domain.
+# Anything beyond that gets a busy answer
+SERVER_WORKERS = int(os.environ.get("DATA_MESH_SERVER_WORKERS", 32))
+SERVER_QUEUE_SIZE = int(os.environ.get("DATA_MESH_SERVER_QUEUE_SIZE", 256))
+SERVER_DOMAIN_QUEUE_SIZE = int(os.environ.get("DATA_MESH_SERVER_DOMAIN_QUEUE_SIZE", 64))
+# Largest message read whole into memory, artifact contents are streamed and not bounded by it
+MAX_MESSAGE_SIZE = int(os.environ.get("DATA_MESH_MAX_MESSAGE_SIZE", 64 * 1024 * 1024))
+# Connections the kernel holds until the server accepts them
+LISTEN_BACKLOG = int(os.environ.get("DATA_MESH_LISTEN_BACKLOG", 128))
+
+# Address outgoing connections are made from, set to the node's own address so peers see the
+# address it serves on, also when several nodes share a host
+_source_address = None
+
+def set_source_address(address):
+    global _source_address
+    _source_address = address
+
+def require_token_secret():
+    # A well-known default secret would let anyone forge tokens
+    if not TOKEN_SECRET:
+        sys.exit("Zero trust needs the token signing secret, set the DATA_MESH_TOKEN_SECRET environment variable")
+
 def choose_from_list(prompt, options):
     print(prompt)
     for idx, option in enumerate(options, start=1):
@@ -25,19 +59,32 @@ def choose_from_list(prompt, options):
         except ValueError:
             print("Please enter a valid number.")
 
+def ask_yes_no(prompt, answer=None):
+    # answer comes from a command line flag, the prompt is only shown without one
+    if answer is None:
+        answer = input(prompt)
+    return answer.strip().lower() == "y"
+
 def ip_setup():
     chosen_ip = choose_from_list("Choose an IP address:", IP_ADDRESSES)
     ip = IP_ADDRESSES[chosen_ip]
     return ip
 
-def socket_setup(server=True):
+def socket_setup(server=True, host=None, reuse_port=False, backlog=LISTEN_BACKLOG):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.settimeout(1.1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     if server:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        host = ip_setup()
+        if reuse_port:
+            # Several processes accept on the same port, the kernel spreads the connections
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if host is None:
+            host = ip_setup()
         port = 9000
         sock.bind((host, port))
-        sock.listen(10)
+        sock.listen(backlog)
         print(f"Host and port {host}:{port}")
-    return sock
\ No newline at end of file
+    elif _source_address is not None:
+        sock.bind((_source_address, 0))
+    return sock
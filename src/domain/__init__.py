@@ -1,3 +1,5 @@
 """Domain"""
 from .artifact import Artifact
-from .data_product import DataProduct
\ No newline at end of file
+from .blob_store import BlobStore
+from .data_product import DataProduct
+from .product_store import ProductStore
\ No newline at end of file
@@ -1,13 +1,34 @@
 class Artifact:
+    __slots__ = ("data_id", "name", "data_product", "data", "blob_key", "blob_size")
+
     def __init__(self, data_id: int, name: str, data_product=None, data=None):
         self.data_id = data_id
         self.name = name
         self.data_product = data_product
         self.data = data if data else {}
+        # Set when the content of the artifact lives in a blob store instead of in memory
+        self.blob_key = None
+        self.blob_size = 0
+
+    def update(self, data):
+        self.data = data
+        if self.data_product is not None:
+            self.data_product.touch()
+
+    def store_blob(self, blob_store, chunks):
+        product_id = self.data_product.data_id if self.data_product is not None else None
+        self.blob_key = f"{product_id}/{self.data_id}"
+        self.blob_size = blob_store.put(self.blob_key, chunks)
+        if self.data_product is not None:
+            self.data_product.touch()
     
     def to_dict(self):
-        return {
+        artifact_dict = {
             "data_id": self.data_id,
             "name": self.name,
             "data": self.data
         }
+        if self.blob_key is not None:
+            # Only the size is sent with the product, the content is read with consume/artifact
+            artifact_dict["blob_size"] = self.blob_size
+        return artifact_dict
@@ -0,0 +1,85 @@
+import json
+import mmap
+import os
+import threading
+
+class BlobStore:
+    def __init__(self, directory="src/domain/blobs", index_path="src/domain/local_db.json"):
+        self.directory = directory
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                local_db = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            local_db = {}
+        return local_db.get("blobs", {})
+
+    def _save_index(self):
+        # Caller holds the lock
+        try:
+            with open(self.index_path, "r") as f:
+                local_db = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            local_db = {}
+        local_db["blobs"] = self._index
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(local_db, f, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def put(self, key, chunks):
+        # Chunks are written as they come, so blobs never have to fit in memory
+        if isinstance(chunks, (bytes, bytearray, memoryview)):
+            chunks = [chunks]
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{key.replace('/', '_')}.blob")
+        size = 0
+        with open(f"{path}.tmp", "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(f"{path}.tmp", path)
+
+        with self._lock:
+            self._index[key] = {"path": path, "size": size}
+            self._save_index()
+        return size
+
+    def size(self, key):
+        return self._index[key]["size"]
+
+    def open(self, key):
+        return open(self._index[key]["path"], "rb")
+
+    def read_range(self, key, offset=0, length=None):
+        offset, length = self.clamp_range(key, offset, length)
+        if length == 0:
+            return b""
+        with self.open(key) as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+                return blob[offset:offset + length]
+
+    def clamp_range(self, key, offset=0, length=None):
+        size = self.size(key)
+        offset = min(max(offset, 0), size)
+        if length is None:
+            length = size - offset
+        return offset, min(max(length, 0), size - offset)
+
+    def remove(self, key):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is None:
+                return
+            self._save_index()
+        try:
+            os.remove(entry["path"])
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, key):
+        return key in self._index
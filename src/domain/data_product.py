@@ -1,9 +1,29 @@
 class DataProduct:
-    def __init__(self, data_id: int, name: str, domain: str, artifacts):
+    __slots__ = ("data_id", "name", "domain", "artifacts", "tags", "revision")
+
+    def __init__(self, data_id: int, name: str, domain: str, artifacts, tags=None):
         self.data_id = data_id
         self.name = name
         self.domain = domain
         self.artifacts = artifacts
+        # Registered with the marketplace so consumers can find the product with discovery queries
+        self.tags = list(tags or [])
+        # Bumped on every change so cached encodings of the product can be invalidated
+        self.revision = 0
+
+    def touch(self):
+        self.revision += 1
+
+    def add_artifact(self, artifact):
+        artifact.data_product = self
+        self.artifacts.append(artifact)
+        self.touch()
+    
+    def get_artifact(self, name):
+        for artifact in self.artifacts:
+            if artifact.name == name:
+                return artifact
+        return None
     
     def to_dict(self):
         return {
@@ -0,0 +1,79 @@
+import json
+import threading
+
+from platform_code.codec import payload_etag
+
+class ProductStore:
+    def __init__(self, products=None):
+        self._lock = threading.Lock()
+        self._by_name = {}
+        self._by_id = {}
+        # name -> {codec name: (product, revision, encoded product, etag)}
+        self._encoded = {}
+        for product in products or []:
+            self.add(product)
+
+    def add(self, product):
+        with self._lock:
+            previous = self._by_name.get(product.name)
+            if previous is not None:
+                self._by_id.pop(previous.data_id, None)
+            self._by_name[product.name] = product
+            self._by_id[product.data_id] = product
+            self._invalidate(product.name)
+
+    def remove(self, name):
+        with self._lock:
+            product = self._by_name.pop(name, None)
+            if product is not None:
+                self._by_id.pop(product.data_id, None)
+                self._invalidate(name)
+            return product
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def get_by_id(self, data_id):
+        return self._by_id.get(data_id)
+
+    def _invalidate(self, name):
+        self._encoded.pop(name, None)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._invalidate(name)
+
+    def versioned(self, name, codec=None):
+        # (etag, encoded product), the etag is hashed once per encoding. (None, None) when unknown
+        product = self._by_name.get(name)
+        if product is None:
+            return None, None
+        codec_name = codec.name if codec is not None else "json"
+        cached = self._encoded.get(name, {}).get(codec_name)
+        # A product replaced under the same name starts at the same revision, so the entry is
+        # only current for the very product it was encoded from
+        if cached is not None and cached[0] is product and cached[1] == product.revision:
+            return cached[3], cached[2]
+        revision = product.revision
+        if codec is not None:
+            payload = codec.encode_product(product)
+        else:
+            payload = json.dumps(product.to_dict()).encode()
+        etag = payload_etag(payload)
+        # Encoding runs outside the lock, the result is kept only if the product was not replaced meanwhile
+        with self._lock:
+            if self._by_name.get(name) is product:
+                self._encoded.setdefault(name, {})[codec_name] = (product, revision, payload, etag)
+        return etag, payload
+
+    def encoded(self, name, codec=None):
+        return self.versioned(name, codec)[1]
+
+    def __iter__(self):
+        return iter(list(self._by_name.values()))
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __contains__(self, name):
+        return name in self._by_name
@@ -1,17 +1,26 @@
+import argparse
+import asyncio
 import json
+import os
 import time
 import csv
-import socket
 import threading
 
 # Local imports
-from config import socket_setup
-from domain import DataProduct, Artifact
-from platform_code import gateway
+from config import PLATFORM_REPLICAS, PLATFORM_SHARDS, ask_yes_no, require_token_secret, set_source_address, socket_setup
+from domain import DataProduct, Artifact, BlobStore, ProductStore
+from platform_code import async_gateway, gateway
+from platform_code.admission import AsyncRequestServer, RequestServer
+from platform_code.instrumentation import metrics, recorder
+from platform_code.peer_selector import selector
 
 # Global variable
-products = []
+products = ProductStore()
+blob_store = BlobStore()
 zero_trust = False
+results_file = None
+last_flush = 0.0
+LATENCY_PATH = "src/domain_app_latency.json"
 
 def _create_product(number: int, domain):
     data_product = DataProduct(
@@ -31,147 +40,212 @@ def _create_artifact(number: int, data_product=None, data={"key": "value"}):
     )
 
 def start_listening(server_socket):
-    server_socket.settimeout(1)
-    while True:
-        try:
-            conn, addr = server_socket.accept()
-            threading.Thread(target=handle_client, args=(conn,)).start()
-        except socket.timeout:
-            continue
-        except KeyboardInterrupt:
-            print("Server shutting down...")
-            break
-
-def handle_client(socket_connection):
-    try:
-        while True:
-            request_type = socket_connection.recv(1024).decode()
-            if not request_type:
-                break
-            elif request_type == "consume":
-                socket_connection.sendall(b"ok")
-
-                if zero_trust:
-                    auth_client_socket = socket_setup(server=False)
-                else:
-                    auth_client_socket = None
-                gateway.server_consume(socket_connection, auth_client_socket, products, zero_trust)
-
-                break
-            else:
-                print(f"Unknown request type: {request_type}")
-            break
-    finally:
-        socket_connection.close()
-
-def time_keeping(start_time):
-    end_time = time.time()
-    elapsed_time = end_time - start_time
+    RequestServer(handle_request).serve(server_socket)
+
+def handle_request(socket_connection, request_type, payload):
+    # Returns whether the connection stays open for the next request
+    if request_type == "handshake":
+        gateway.server_handshake(socket_connection, json.loads(payload))
+    elif request_type == "consume":
+        gateway.server_consume(socket_connection, products, zero_trust, json.loads(payload))
+    elif request_type == "consume/batch":
+        gateway.server_consume_batch(socket_connection, products, zero_trust, json.loads(payload))
+    elif request_type == "consume/artifact":
+        gateway.server_consume_artifact(socket_connection, products, blob_store, zero_trust, json.loads(payload))
+    elif request_type == "stats":
+        gateway.server_stats(socket_connection, payload.decode())
+    else:
+        print(f"Unknown request type: {request_type}")
+        return False
+    return True
+
+async def handle_request_async(writer, request_type, payload):
+    if request_type == "handshake":
+        await async_gateway.server_handshake(writer, json.loads(payload))
+    elif request_type == "consume":
+        await async_gateway.server_consume(writer, products, zero_trust, json.loads(payload))
+    elif request_type == "consume/batch":
+        await async_gateway.server_consume_batch(writer, products, zero_trust, json.loads(payload))
+    elif request_type == "consume/artifact":
+        await async_gateway.server_consume_artifact(writer, products, blob_store, zero_trust, json.loads(payload))
+    elif request_type == "stats":
+        await async_gateway.server_stats(writer, payload.decode())
+    else:
+        print(f"Unknown request type: {request_type}")
+        return False
+    return True
+
+async def start_listening_async(server_socket):
+    await AsyncRequestServer(handle_request_async).serve(server_socket)
+
+def parse_args(argv=None):
+    # Every setting that is left out is asked for interactively
+    parser = argparse.ArgumentParser(description="Run a domain node of the data mesh")
+    parser.add_argument("--host", help="Address to serve on and connect from")
+    parser.add_argument("--platform", help="Platform IP, instead of the shards in config.py")
+    parser.add_argument("--zero-trust", choices=("y", "n"), help="Attach platform tokens to consumes")
+    parser.add_argument("--asyncio", choices=("y", "n"), help="Serve on an asyncio event loop")
+    parser.add_argument("--subscribe", choices=("y", "n"), help="Subscribe to the marketplace instead of polling")
+    parser.add_argument("--view", choices=("y", "n"), help="Consume every product in the mesh per iteration")
+    parser.add_argument("--products", type=int, default=1, help="Number of data products this domain serves")
+    parser.add_argument("--iterations", type=int, default=1_000_000, help="Number of consume iterations")
+    parser.add_argument("--start-file",
+                        help="Start consuming once this file exists, instead of waiting for Enter")
+    parser.add_argument("--output-dir", default="src", help="Directory for domain_app.csv and the latency histograms")
+    return parser.parse_args(argv)
+
+def time_keeping(start_time, success=True):
+    global last_flush
+    elapsed_time = time.perf_counter() - start_time
+    recorder.record("iteration" if success else "iteration/failed", elapsed_time)
     print("=====================\n")
     print(f"Elapsed time: {elapsed_time} seconds")
     print("\n=====================")
 
-    with open("src/domain_app.csv", "a", newline='') as f:
-        writer = csv.writer(f, delimiter=';')
-        writer.writerow([elapsed_time])
+    writer = csv.writer(results_file, delimiter=';')
+    writer.writerow([elapsed_time] if success else ["No product found"])
+    if time.monotonic() - last_flush > 1:
+        results_file.flush()
+        last_flush = time.monotonic()
 
 if __name__ == "__main__":
     '''
     Zero Trust, and clear files
     ==========================
     '''
-    zero_trust = input("Should the program use zero trust? (y/n): ").strip().lower() == "y"
-
-    with open("src/domain_app.csv", "w") as f:
-        writer = csv.writer(f)
-
-    with open("src/platform_code/local_db.json", "w") as f:
-        platform_up = '{"platform": {"domain": "10.0.3.5"} }'
-        json.dump(json.loads(platform_up), f, indent=4)
-
-    with open("src/platform_code/local_db.json", "r") as f:
-        db = json.load(f)
-    platform_ip = db["platform"]["domain"]
+    args = parse_args()
+    zero_trust = ask_yes_no("Should the program use zero trust? (y/n): ", args.zero_trust)
+    if zero_trust:
+        require_token_secret()
+    use_asyncio = ask_yes_no("Should the domain server use asyncio? (y/n): ", args.asyncio)
+    use_subscription = ask_yes_no("Should the domain subscribe to marketplace updates instead of polling? (y/n): ", args.subscribe)
+    use_view = ask_yes_no("Should every iteration consume all products in the mesh at once? (y/n): ", args.view)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_file = open(os.path.join(args.output_dir, "domain_app.csv"), "w", newline='')
+    latency_path = os.path.join(args.output_dir, os.path.basename(LATENCY_PATH))
+    recorder.start(latency_path)
+    metrics.gauge("products_served", lambda: len(products))
+
+    if args.platform:
+        platform_up = {"platform": {"domain": args.platform, "shards": [args.platform], "replicas": {}}}
+    else:
+        platform_up = {"platform": {"domain": "10.0.3.5", "shards": PLATFORM_SHARDS, "replicas": PLATFORM_REPLICAS}}
+    # Written atomically, domains sharing a host read the file while others write it
+    tmp_path = f"src/platform_code/local_db.json.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(platform_up, f, indent=4)
+    os.replace(tmp_path, "src/platform_code/local_db.json")
     '''
     Starting the domain server socket
     ==========================
     '''
-    domain_server = socket_setup()
-    threading.Thread(target=start_listening, args=(domain_server,), daemon=True).start()
+    domain_server = socket_setup(host=args.host)
+    if use_asyncio:
+        threading.Thread(target=asyncio.run, args=(start_listening_async(domain_server),), daemon=True).start()
+    else:
+        threading.Thread(target=start_listening, args=(domain_server,), daemon=True).start()
 
     domain_ip = domain_server.getsockname()[0]
+    set_source_address(domain_ip)
     print(f"Domain server started at {domain_ip}")
     '''
-    Announce presence to the platform
+    Create the data products and artifacts
     ==========================
     '''
-    hello_client = socket_setup(server=False)
-    gateway.client_hello(hello_client)
-    hello_client.close()
-    '''
-    Create a data product and artifacts
-    ==========================
-    '''
-    data_product = _create_product(1, domain_ip)
-    products.append(data_product)
+    for number in range(1, args.products + 1):
+        data_product = _create_product(number, domain_ip)
+        products.add(data_product)
 
-    artifact = _create_artifact(1, data_product=data_product, data={"key1": "value1"})
-    data_product.artifacts.append(artifact)
+        artifact = _create_artifact(number, data_product=data_product, data={f"key{number}": f"value{number}"})
+        data_product.add_artifact(artifact)
     '''
-    Make the data product discoverable
+    Announce presence to the platform and make the data products discoverable
     ==========================
     '''
-    register_client_socket = socket_setup(server=False)
-    gateway.client_discover_registration(register_client_socket, data_product)
-    register_client_socket.close()
+    gateway.client_hello(list(products))
     '''
     Choose products from the mesh on repeat
     ==========================
     '''
-    input("Press Enter to start consuming products from the mesh...")
+    if use_subscription:
+        gateway.client_subscribe()
 
-    for i in range(0, 1_000_000):
-        print(f"Iteration {i}")
-        start_time = time.time()
+    if args.start_file is None:
+        input("Press Enter to start consuming products from the mesh...")
+    else:
+        while not os.path.exists(args.start_file):
+            time.sleep(0.01)
 
-        discover_client_socket = socket_setup(server=False)
-        mesh_products_json = gateway.client_discover_products(discover_client_socket)
-        if mesh_products_json is None:
-            time.sleep(1)
-            time_keeping(start_time)
-            continue
-        mesh_products = json.loads(mesh_products_json)
+    # The launcher interrupts domains that are still consuming when a run ends
+    interrupted = False
+    try:
+        for i in range(0, args.iterations):
+            print(f"Iteration {i}")
+            start_time = time.perf_counter()
 
-        choose_products = []
-        for product in mesh_products:
-            if product[1] != domain_ip:
-                choose_products.append(product)
+            if use_subscription:
+                mesh_products = gateway.subscribed_products()
+            else:
+                mesh_products = gateway.client_discover_products()
+            if mesh_products is None:
+                time.sleep(1)
+                time_keeping(start_time, success=False)
+                continue
+
+            choose_products = []
+            for product in mesh_products:
+                if product[1] != domain_ip:
+                    choose_products.append(product)
         
-        if len(choose_products) == 0:
-            time.sleep(1)
-            time_keeping(start_time)
-            continue
-        else:
-            chosen_product = choose_products[i % len(choose_products)]
-
-        consume_client_socket = socket_setup(server=False)
-        product_name = chosen_product[0]
-        domain = chosen_product[1]
-        product = gateway.client_consume(consume_client_socket, product_name, domain)
+            if len(choose_products) == 0:
+                time.sleep(1)
+                time_keeping(start_time, success=False)
+                continue
+
+            if use_view:
+                # One batched request per domain, all domains in parallel
+                chosen_products = selector.choose_all(choose_products)
+                consumed = gateway.client_consume_many(chosen_products, zero_trust)
+                if not chosen_products or len(consumed) < len(chosen_products):
+                    time.sleep(min(selector.retry_delay(choose_products), 1))
+                    time_keeping(start_time, success=False)
+                    continue
+                time_keeping(start_time)
+                print(f"Products: {len(consumed)}")
+                continue
+
+            # Fastest healthy replica, domains with an open circuit are skipped until their backoff ends
+            chosen_product = selector.choose(choose_products, i)
+            if chosen_product is None:
+                time.sleep(min(selector.retry_delay(choose_products), 1))
+                time_keeping(start_time, success=False)
+                continue
+
+            product_name = chosen_product[0]
+            domain = chosen_product[1]
+            product = gateway.client_consume(product_name, domain, zero_trust)
         
-        if product is None:
-            time.sleep(1)
-            time_keeping(start_time)
-            continue
+            if product is None:
+                # Retry right away when another replica is still available
+                time.sleep(min(selector.retry_delay(choose_products), 1))
+                time_keeping(start_time, success=False)
+                continue
 
-        time_keeping(start_time)
-        print(f"Product: {product}")
+            time_keeping(start_time)
+            print(f"Product: {product}")
+    except KeyboardInterrupt:
+        interrupted = True
     '''
     Make sure the server do not exit
     ==========================
     '''
+    results_file.flush()
     try:
-        while True:
+        while not interrupted:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("Shutting down...")
\ No newline at end of file
+        pass
+    print("Shutting down...")
+    results_file.close()
+    recorder.stop(latency_path)
\ No newline at end of file
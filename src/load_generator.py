@@ -0,0 +1,243 @@
+import argparse
+import csv
+import json
+import queue
+import random
+import threading
+import time
+
+from platform_code import gateway
+from platform_code.instrumentation import recorder
+from platform_code.peer_selector import selector
+
+def _write_platform_ip(platform_ip):
+    with open("src/platform_code/local_db.json", "w") as f:
+        json.dump({"platform": {"domain": platform_ip}}, f, indent=4)
+
+class LoadGenerator:
+    def __init__(self, workers=1, rate=0.0, duration=None, requests=None, consume_ratio=0.5,
+                 zero_trust=False, domain_ip=None, seed=None, view=False):
+        self.workers = workers
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.consume_ratio = consume_ratio
+        self.zero_trust = zero_trust
+        self.domain_ip = domain_ip
+        self.view = view
+        self.random = random.Random(seed)
+        self.results = []
+        self._results_lock = threading.Lock()
+        self._catalog = []
+        self._catalog_lock = threading.Lock()
+        self._issued = 0
+        self._issued_lock = threading.Lock()
+
+    '''
+    Operations
+    ==========================
+    '''
+    def _discover(self):
+        mesh_products = gateway.client_discover_products()
+        if mesh_products is None:
+            return False, None
+        with self._catalog_lock:
+            self._catalog = [product for product in mesh_products if product[1] != self.domain_ip]
+        return True, None
+
+    def _consume(self, sequence):
+        with self._catalog_lock:
+            catalog = self._catalog
+        if not catalog:
+            ok, _ = self._discover()
+            with self._catalog_lock:
+                catalog = self._catalog
+            if not ok or not catalog:
+                return False, None
+        if self.view:
+            chosen = selector.choose_all(catalog)
+            consumed = gateway.client_consume_many(chosen, self.zero_trust)
+            return bool(chosen) and len(consumed) == len(chosen), None
+        chosen = selector.choose(catalog, sequence)
+        if chosen is None:
+            return False, None
+        product_name, domain = chosen
+        product = gateway.client_consume(product_name, domain, self.zero_trust)
+        return product is not None, domain
+
+    def _run_operation(self, sequence, scheduled):
+        if self.random.random() < self.consume_ratio:
+            operation = "consume"
+        else:
+            operation = "discover"
+
+        start = time.perf_counter()
+        try:
+            if operation == "consume":
+                ok, domain = self._consume(sequence)
+            else:
+                ok, domain = self._discover()
+        except Exception as e:
+            print(f"Error in load generator {operation}: {e}")
+            ok, domain = False, None
+        end = time.perf_counter()
+
+        with self._results_lock:
+            self.results.append({
+                "operation": operation,
+                "domain": domain,
+                "ok": ok,
+                # Open-loop latency counts the time a request waited for a free worker
+                "latency": end - (scheduled if scheduled is not None else start),
+                "service_time": end - start,
+                "start": start,
+            })
+
+    def _next_sequence(self):
+        with self._issued_lock:
+            if self.requests is not None and self._issued >= self.requests:
+                return None
+            self._issued += 1
+            return self._issued - 1
+
+    '''
+    Closed and open loop
+    ==========================
+    '''
+    def _closed_loop_worker(self, deadline):
+        while deadline is None or time.perf_counter() < deadline:
+            sequence = self._next_sequence()
+            if sequence is None:
+                return
+            self._run_operation(sequence, None)
+
+    def _open_loop_worker(self, schedule):
+        while True:
+            item = schedule.get()
+            if item is None:
+                return
+            self._run_operation(*item)
+
+    def _open_loop_dispatch(self, schedule, deadline):
+        interval = 1 / self.rate
+        next_time = time.perf_counter()
+        while deadline is None or next_time < deadline:
+            sequence = self._next_sequence()
+            if sequence is None:
+                break
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            schedule.put((sequence, next_time))
+            next_time += interval
+        for _ in range(self.workers):
+            schedule.put(None)
+
+    def run(self):
+        self.started = time.perf_counter()
+        deadline = self.started + self.duration if self.duration is not None else None
+
+        if self.rate > 0:
+            schedule = queue.Queue()
+            threads = [threading.Thread(target=self._open_loop_worker, args=(schedule,), daemon=True)
+                       for _ in range(self.workers)]
+            threads.append(threading.Thread(target=self._open_loop_dispatch, args=(schedule, deadline), daemon=True))
+        else:
+            threads = [threading.Thread(target=self._closed_loop_worker, args=(deadline,), daemon=True)
+                       for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self.results
+
+    '''
+    Results
+    ==========================
+    '''
+    def summary(self):
+        summary = {
+            "elapsed": self.elapsed,
+            "requests": len(self.results),
+            "throughput": len(self.results) / self.elapsed if self.elapsed > 0 else 0,
+            "operations": {},
+        }
+        for operation in ("discover", "consume"):
+            results = [result for result in self.results if result["operation"] == operation]
+            latencies = sorted(result["latency"] for result in results if result["ok"])
+            failures = sum(1 for result in results if not result["ok"])
+            operation_summary = {"requests": len(results), "failures": failures}
+            if latencies:
+                operation_summary.update({
+                    "mean": sum(latencies) / len(latencies),
+                    "p50": _percentile(latencies, 50),
+                    "p95": _percentile(latencies, 95),
+                    "p99": _percentile(latencies, 99),
+                    "max": latencies[-1],
+                })
+            summary["operations"][operation] = operation_summary
+        # Per-phase histograms recorded by the gateway client functions
+        summary["phases"] = recorder.snapshot()
+        summary["peers"] = selector.snapshot()
+        return summary
+
+    def write_results(self, output, config):
+        with open(output, "w") as f:
+            json.dump({"config": config, "summary": self.summary()}, f, indent=4)
+
+        csv_output = output.rsplit(".", 1)[0] + ".csv"
+        with open(csv_output, "w", newline='') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(["start", "operation", "domain", "ok", "latency", "service_time"])
+            for result in sorted(self.results, key=lambda result: result["start"]):
+                writer.writerow([
+                    f"{result['start'] - self.started:.6f}", result["operation"], result["domain"],
+                    int(result["ok"]), f"{result['latency']:.6f}", f"{result['service_time']:.6f}",
+                ])
+
+def _percentile(sorted_values, percentile):
+    index = min(len(sorted_values) - 1, int(round(percentile / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate discover and consume load against the data mesh")
+    parser.add_argument("--platform", help="Platform IP, written to the local database before the run")
+    parser.add_argument("--workers", type=int, default=1, help="Number of concurrent workers")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Open-loop target rate in requests per second, 0 runs closed-loop")
+    parser.add_argument("--duration", type=float, help="Stop after this many seconds")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests")
+    parser.add_argument("--consume-ratio", type=float, default=0.5,
+                        help="Share of consume operations, the rest are discovers")
+    parser.add_argument("--zero-trust", action="store_true", help="Attach platform tokens to consumes")
+    parser.add_argument("--domain-ip", help="Skip products from this domain")
+    parser.add_argument("--seed", type=int, help="Seed for the operation mix")
+    parser.add_argument("--view", action="store_true",
+                        help="Consume every product in the mesh per consume, one batched request per domain in parallel")
+    parser.add_argument("--output", default="src/load_generator.json",
+                        help="JSON summary file, per-request results go to the matching .csv")
+    args = parser.parse_args(argv)
+    if args.duration is None and args.requests is None:
+        parser.error("one of --duration or --requests is required")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.platform:
+        _write_platform_ip(args.platform)
+
+    generator = LoadGenerator(
+        workers=args.workers,
+        rate=args.rate,
+        duration=args.duration,
+        requests=args.requests,
+        consume_ratio=args.consume_ratio,
+        zero_trust=args.zero_trust,
+        domain_ip=args.domain_ip,
+        seed=args.seed,
+        view=args.view,
+    )
+    generator.run()
+    generator.write_results(args.output, vars(args))
+    print(json.dumps(generator.summary(), indent=4))
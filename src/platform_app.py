@@ -1,81 +1,188 @@
-import threading
-import socket
+import argparse
+import asyncio
 import json
+import multiprocessing
+import os
+import threading
+import time
 
-from config import socket_setup
-from platform_code import authenticate, gateway, logger
+from config import ask_yes_no, ip_setup, require_token_secret, socket_setup
+from platform_code import async_gateway, authenticate, gateway, logger
+from platform_code.admission import AsyncRequestServer, RequestServer
+from platform_code.shared_registry import CatalogFollower, CatalogPublisher, SharedCatalog, WriterChannel
 
 zero_trust = False
 
 def start_listening(server_socket):
-    server_socket.settimeout(1)
-    while True:
+    RequestServer(handle_request, streaming=("subscribe",)).serve(server_socket)
+
+def handle_request(socket_connection, request_type, payload):
+    # Returns whether the connection stays open for the next request
+    if request_type == "hello":
+        gateway.server_hello(socket_connection, zero_trust, payload)
+
+    elif request_type == "discover/registration":
+        gateway.platform_discover_registration(socket_connection, payload.decode(), zero_trust)
+
+    elif request_type == "discover":
+        gateway.server_discover_products(socket_connection, payload.decode(), zero_trust)
+
+    elif request_type == "discover/query":
+        gateway.server_query_products(socket_connection, json.loads(payload), zero_trust)
+
+    elif request_type == "authenticate":
+        authenticate.server_authenticate(socket_connection, payload.decode())
+
+    elif request_type == "stats":
+        gateway.server_stats(socket_connection, payload.decode())
+
+    elif request_type == "subscribe":
+        gateway.server_subscribe(socket_connection, payload.decode(), zero_trust)
+        return False
+
+    else:
+        print(f"Unknown request type: {request_type}")
+        return False
+    return True
+
+async def handle_request_async(writer, request_type, payload):
+    if request_type == "hello":
+        await async_gateway.server_hello(writer, zero_trust, payload)
+
+    elif request_type == "discover/registration":
+        await async_gateway.platform_discover_registration(writer, payload.decode(), zero_trust)
+
+    elif request_type == "discover":
+        await async_gateway.server_discover_products(writer, payload.decode(), zero_trust)
+
+    elif request_type == "discover/query":
+        await async_gateway.server_query_products(writer, json.loads(payload), zero_trust)
+
+    elif request_type == "authenticate":
+        await async_gateway.server_authenticate(writer, payload.decode())
+
+    elif request_type == "stats":
+        await async_gateway.server_stats(writer, payload.decode())
+
+    elif request_type == "subscribe":
+        await async_gateway.server_subscribe(writer, payload.decode(), zero_trust)
+        return False
+
+    else:
+        print(f"Unknown request type: {request_type}")
+        return False
+    return True
+
+async def start_listening_async(server_socket):
+    await AsyncRequestServer(handle_request_async, streaming=("subscribe",)).serve(server_socket)
+
+def serve(server_socket, use_asyncio):
+    if use_asyncio:
         try:
-            conn, addr = server_socket.accept()
-            threading.Thread(target=handle_client, args=(conn,)).start()
-        except socket.timeout:
-            continue
+            asyncio.run(start_listening_async(server_socket))
         except KeyboardInterrupt:
             print("Server shutting down...")
-            log_file.close()
-            break
+    else:
+        start_listening(server_socket)
+
+def _exit_with_parent(parent_pid):
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
 
-def handle_client(socket_connection):
+def run_worker(host, writer_connection, catalog, log_queue, use_asyncio, parent_pid, primary):
+    # Pre-forked worker: accepts on the shared port, reads the marketplace from shared memory
+    # and sends registrations to the writing process
+    threading.Thread(target=_exit_with_parent, args=(parent_pid,), daemon=True).start()
+    logger.forward_to(log_queue)
+    # Workers of a replica reject hello and registrations themselves
+    gateway.registry.primary = primary or None
+    follower = CatalogFollower(gateway.registry, catalog).start()
+    gateway.registry.writer = WriterChannel(writer_connection, follower)
     try:
-        while True:
-            request_type = socket_connection.recv(1024).decode()
-
-            if not request_type:
-                break
-            elif request_type == "hello":
-                socket_connection.sendall(b"ok")
-                gateway.server_hello(socket_connection, zero_trust)
-
-            elif request_type == "discover/registration":
-                socket_connection.sendall(b"ok")
-                gateway.platform_discover_registration(socket_connection, zero_trust)
-
-            elif request_type == "discover":
-                socket_connection.sendall(b"ok")
-                gateway.server_discover_products(socket_connection, zero_trust)
-
-            elif request_type == "authenticate":
-                socket_connection.sendall(b"ok")
-                authenticate.server_authenticate(socket_connection)
-
-            break
-    except Exception as e:
-        print(f"Error handling client: {e}")
+        serve(socket_setup(host=host, reuse_port=True), use_asyncio)
     finally:
-        socket_connection.close()
+        logger.stop()
+
+def start_workers(host, workers, use_asyncio, primary=None):
+    # Workers are forked before this process starts any thread
+    catalog = SharedCatalog()
+    log_queue = multiprocessing.Queue()
+    connections = []
+    processes = []
+    for _ in range(workers):
+        connection, worker_connection = multiprocessing.Pipe()
+        connections.append(connection)
+        processes.append(multiprocessing.Process(
+            target=run_worker, args=(host, worker_connection, catalog, log_queue, use_asyncio, os.getpid(), primary), daemon=True,
+        ))
+    for process in processes:
+        process.start()
+    logger.receive_forwarded(log_queue)
+    CatalogPublisher(gateway.registry, catalog).serve(connections)
+    return catalog, processes
+
+def parse_args(argv=None):
+    # Every setting that is left out is asked for interactively
+    parser = argparse.ArgumentParser(description="Run a platform node of the data mesh")
+    parser.add_argument("--host", help="Address to serve on")
+    parser.add_argument("--zero-trust", choices=("y", "n"), help="Run in zero-trust mode")
+    parser.add_argument("--asyncio", choices=("y", "n"), help="Serve on an asyncio event loop")
+    parser.add_argument("--binary-log", choices=("y", "n"), help="Log in the compact binary format")
+    parser.add_argument("--primary", help="Primary platform IP to replicate, empty to run a primary")
+    parser.add_argument("--workers", type=int, help="Worker processes accepting connections")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    zero_trust = input("Do you want to enable zero trust? (y/n): ").strip().lower() == 'y'
+    args = parse_args()
+    zero_trust = ask_yes_no("Do you want to enable zero trust? (y/n): ", args.zero_trust)
+    if zero_trust:
+        require_token_secret()
+    use_asyncio = ask_yes_no("Do you want to use the asyncio server? (y/n): ", args.asyncio)
+    if ask_yes_no("Do you want to log in the compact binary format? (y/n): ", args.binary_log):
+        logger.set_log_format("binary")
+    primary = args.primary
+    if primary is None:
+        primary = input("Primary platform IP to replicate, leave empty to run a primary: ")
+    primary = primary.strip()
+    workers = args.workers
+    if workers is None:
+        workers = int(input("How many worker processes should accept connections? (1 for a single process): ").strip() or 1)
 
-    with open("src/platform_code/marketplace.json", "w") as f:
-        json.dump({}, f, indent=4)
     logger.reset_log_file()
+    gateway.register_marketplace_gauges()
+
+    if workers > 1:
+        host = args.host or ip_setup()
+        gateway.registry.reset(host)
+        catalog, processes = start_workers(host, workers, use_asyncio, primary)
+        gateway.registry.start()
+        if primary:
+            gateway.platform_follow(primary)
+        print(f"Host and port {host}:9000 with {workers} workers")
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            print("Server shutting down...")
+        catalog.close()
+    else:
+        server = socket_setup(host=args.host)
 
-    server = socket_setup()
-
-    log_file = open("src/platform_code/log.csv", "a+b")
-    '''
-    Writing the platforms ip to the marketplace
-    ====================
-    '''
-    host = server.getsockname()[0]
-    with open("src/platform_code/marketplace.json", "r") as f:
-        marketplace = json.load(f)
-    if "platform" not in marketplace:
-        marketplace["platform"] = {
-            "domain": host,
-            "products": []
-        }
-        with open("src/platform_code/marketplace.json", "w") as f:
-            json.dump(marketplace, f, indent=4)
-    print(f"Host and port {host}:{server.getsockname()[1]}")
-    '''
-    Starting the platform server socket
-    ====================
-    '''
-    start_listening(server)
\ No newline at end of file
+        '''
+        Writing the platforms ip to the marketplace
+        ====================
+        '''
+        host = server.getsockname()[0]
+        gateway.registry.reset(host)
+        gateway.registry.start()
+        if primary:
+            gateway.platform_follow(primary)
+        print(f"Host and port {host}:{server.getsockname()[1]}")
+        '''
+        Starting the platform server socket
+        ====================
+        '''
+        serve(server, use_asyncio)
+    gateway.registry.stop()
+    logger.stop()
@@ -0,0 +1,293 @@
+import asyncio
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from config import SERVER_DOMAIN_QUEUE_SIZE, SERVER_QUEUE_SIZE, SERVER_WORKERS
+from .connection_pool import SERVER_IDLE_TIMEOUT
+from .instrumentation import metrics, recorder
+from .protocol import MessageReader, read_message, send_message, write_message
+
+# Seconds a rejected client should wait before it sends the same server another request
+BUSY_RETRY_AFTER = 0.05
+# Once a request starts to arrive it has to be complete within this time
+READ_TIMEOUT = 5
+
+def record_request(request_type, start):
+    metrics.add("requests_total", type=request_type)
+    recorder.record(f"serve/{request_type}", time.perf_counter() - start)
+
+class FairQueue:
+    # One queue per domain, served round-robin, so a domain that floods the server only delays
+    # its own requests. Callers hold their own lock
+    def __init__(self, max_size=SERVER_QUEUE_SIZE, max_domain_size=SERVER_DOMAIN_QUEUE_SIZE):
+        self.max_size = max_size
+        self.max_domain_size = max_domain_size
+        self._queues = collections.OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, domain, item):
+        # False when the request is not admitted
+        queue = self._queues.get(domain)
+        if self._size >= self.max_size or (queue is not None and len(queue) >= self.max_domain_size):
+            return False
+        if queue is None:
+            queue = self._queues[domain] = collections.deque()
+        queue.append(item)
+        self._size += 1
+        return True
+
+    def pop(self):
+        if not self._queues:
+            return None
+        domain, queue = next(iter(self._queues.items()))
+        item = queue.popleft()
+        self._size -= 1
+        if queue:
+            self._queues.move_to_end(domain)
+        else:
+            del self._queues[domain]
+        return item
+
+'''
+Thread servers
+=========================
+'''
+class RequestServer:
+    # A fixed set of worker threads serves every connection. Idle connections wait in a selector.
+    # Requests are read piece by piece as they arrive, so a slow or stalled client holds up no one
+    # else, and queued for the workers once complete, or answered busy when the queue is full
+    def __init__(self, handle_request, workers=SERVER_WORKERS, streaming=(), queue=None):
+        # handle_request(sock, request_type, payload) returns whether the connection stays open
+        self.handle_request = handle_request
+        self.workers = workers
+        # Long-lived requests like subscriptions get their own thread instead of holding a worker
+        self.streaming = streaming
+        self._queue = FairQueue() if queue is None else queue
+        self._ready = threading.Condition()
+        self._selector = selectors.DefaultSelector()
+        # Connections workers are done with, registered again by the accepting thread
+        self._returned = collections.deque()
+        self._wakeup, self._waker = socket.socketpair()
+        # When each watched connection is closed: idle ones after SERVER_IDLE_TIMEOUT, ones in the
+        # middle of a request READ_TIMEOUT after it started to arrive
+        self._deadlines = {}
+        self._peers = {}
+
+    def _watch(self, conn):
+        self._selector.register(conn, selectors.EVENT_READ, MessageReader())
+        self._deadlines[conn] = time.monotonic() + SERVER_IDLE_TIMEOUT
+
+    def _close(self, conn):
+        self._deadlines.pop(conn, None)
+        self._peers.pop(conn, None)
+        conn.close()
+        metrics.adjust("connections_active", -1)
+
+    def _accept(self, server_socket):
+        while True:
+            try:
+                conn, addr = server_socket.accept()
+            except (BlockingIOError, socket.timeout):
+                return
+            except OSError as e:
+                # Out of file descriptors, the pending connections wait in the backlog
+                print(f"Error accepting connection: {e}")
+                return
+            # Only read when the selector reports data, the timeout bounds the workers' writes
+            conn.settimeout(READ_TIMEOUT)
+            metrics.adjust("connections_active", 1)
+            self._peers[conn] = addr[0]
+            self._watch(conn)
+
+    def _receive(self, key):
+        conn, reader = key.fileobj, key.data
+        started = reader.started
+        try:
+            message = reader.feed(conn)
+        except Exception as e:
+            # Closed connections and broken frames end this connection only
+            if not isinstance(e, OSError):
+                print(f"Error reading request: {e}")
+            message = (None, b"")
+        if message is None:
+            if not started:
+                self._deadlines[conn] = time.monotonic() + READ_TIMEOUT
+            return
+        self._selector.unregister(conn)
+        self._deadlines.pop(conn, None)
+        request_type, payload = message
+        if not request_type:
+            self._close(conn)
+            return
+
+        if request_type in self.streaming:
+            threading.Thread(target=self._stream, args=(conn, request_type, payload), daemon=True).start()
+            return
+        with self._ready:
+            admitted = self._queue.put(self._peers[conn], (conn, request_type, payload))
+            if admitted:
+                self._ready.notify()
+        if admitted:
+            return
+        metrics.add("requests_rejected_total", type=request_type)
+        try:
+            send_message(conn, "busy", str(BUSY_RETRY_AFTER))
+        except OSError:
+            self._close(conn)
+            return
+        self._watch(conn)
+
+    def _take_returned(self):
+        while self._returned:
+            self._watch(self._returned.popleft())
+
+    def _close_expired(self):
+        now = time.monotonic()
+        # Workers and streams close connections from their own threads, so iterate over a copy
+        for conn in [conn for conn, deadline in list(self._deadlines.items()) if deadline < now]:
+            self._selector.unregister(conn)
+            self._close(conn)
+
+    def _work(self):
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+                conn, request_type, payload = self._queue.pop()
+            start = time.perf_counter()
+            try:
+                keep = self.handle_request(conn, request_type, payload)
+            except OSError:
+                keep = False
+            except Exception as e:
+                print(f"Error handling client: {e}")
+                keep = False
+            record_request(request_type, start)
+            if not keep:
+                self._close(conn)
+                continue
+            self._returned.append(conn)
+            self._waker.send(b"\0")
+
+    def _stream(self, conn, request_type, payload):
+        metrics.add("requests_total", type=request_type)
+        try:
+            self.handle_request(conn, request_type, payload)
+        except OSError:
+            pass
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            self._close(conn)
+
+    def serve(self, server_socket):
+        server_socket.setblocking(False)
+        self._wakeup.setblocking(False)
+        self._selector.register(server_socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        try:
+            while True:
+                for key, _ in self._selector.select(timeout=1):
+                    if key.fileobj is server_socket:
+                        self._accept(server_socket)
+                    elif key.fileobj is self._wakeup:
+                        self._wakeup.recv(4096)
+                    else:
+                        self._receive(key)
+                self._take_returned()
+                self._close_expired()
+        except KeyboardInterrupt:
+            print("Server shutting down...")
+
+'''
+Asyncio servers
+=========================
+'''
+class AsyncAdmission:
+    # Bounds the requests an asyncio server works on at once, waiting requests use the same fair queue
+    def __init__(self, workers=SERVER_WORKERS, queue=None):
+        self.workers = workers
+        self._active = 0
+        self._queue = FairQueue() if queue is None else queue
+
+    async def acquire(self, domain):
+        # False when the server is too busy to queue the request
+        if self._active < self.workers:
+            self._active += 1
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        if not self._queue.put(domain, waiter):
+            return False
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        return True
+
+    def release(self):
+        # The slot goes straight to the next waiter
+        while self._queue:
+            waiter = self._queue.pop()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+class AsyncRequestServer:
+    # The asyncio counterpart of RequestServer, every connection is a task and at most workers
+    # requests are handled at once
+    def __init__(self, handle_request, workers=SERVER_WORKERS, streaming=(), queue=None):
+        # await handle_request(writer, request_type, payload) returns whether the connection stays open
+        self.handle_request = handle_request
+        # Long-lived requests like subscriptions do not take one of the admitted slots
+        self.streaming = streaming
+        self.admission = AsyncAdmission(workers, queue)
+
+    async def _serve_request(self, writer, addr, request_type, payload):
+        if request_type in self.streaming:
+            metrics.add("requests_total", type=request_type)
+            await self.handle_request(writer, request_type, payload)
+            return False
+        if not await self.admission.acquire(addr):
+            metrics.add("requests_rejected_total", type=request_type)
+            await write_message(writer, "busy", str(BUSY_RETRY_AFTER))
+            return True
+        start = time.perf_counter()
+        try:
+            return await self.handle_request(writer, request_type, payload)
+        finally:
+            self.admission.release()
+            record_request(request_type, start)
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info("peername")[0]
+        metrics.adjust("connections_active", 1)
+        try:
+            while True:
+                request_type, payload = await asyncio.wait_for(read_message(reader), SERVER_IDLE_TIMEOUT)
+                if not request_type:
+                    break
+                if not await self._serve_request(writer, addr, request_type, payload):
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            metrics.adjust("connections_active", -1)
+            writer.close()
+
+    async def serve(self, server_socket):
+        server = await asyncio.start_server(self.handle_client, sock=server_socket)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,137 @@
+import asyncio
+import json
+
+# Local imports
+from .authenticate import authentication_response
+from .codec import choose_codec
+from .gateway import (
+    SUBSCRIPTION_HEARTBEAT, artifact_range, consume_allowed, consume_batch_response, consume_response,
+    hello_request, query_response, registration_request, registry, stats_response,
+)
+from .logger import log
+from .protocol import write_file, write_message
+from .registry import SUBSCRIPTION_QUEUE_SIZE
+
+def _peer_addr(writer):
+    return writer.get_extra_info("peername")[0]
+
+def _log_helper(message, writer):
+    log(message, _peer_addr(writer))
+
+'''
+Functions used by the domains
+=========================
+'''
+async def server_consume(writer, products, zero_trust, consume_request):
+    if not consume_allowed(_peer_addr(writer), zero_trust, consume_request.get("token"), consume_request["product"]):
+        await write_message(writer, "error", "Not authenticated")
+        return
+
+    await write_message(writer, *consume_response(products, consume_request))
+
+async def server_consume_batch(writer, products, zero_trust, batch_request):
+    addr = _peer_addr(writer)
+    if not consume_allowed(addr, zero_trust, batch_request.get("token")):
+        await write_message(writer, "error", "Not authenticated")
+        return
+
+    await write_message(writer, *consume_batch_response(products, batch_request, addr))
+
+async def server_stats(writer, request_format):
+    await write_message(writer, *stats_response(request_format))
+
+async def server_handshake(writer, handshake_request):
+    await write_message(writer, "ok", choose_codec(handshake_request.get("codecs", [])))
+
+async def server_consume_artifact(writer, products, blob_store, zero_trust, artifact_request):
+    if not consume_allowed(_peer_addr(writer), zero_trust, artifact_request.get("token"), artifact_request["product"]):
+        await write_message(writer, "error", "Not authenticated")
+        return
+
+    error, artifact, offset, length = artifact_range(products, blob_store, artifact_request)
+    if error is not None:
+        await write_message(writer, "error", error)
+    elif artifact.blob_key is None:
+        content = memoryview(json.dumps(artifact.data).encode())
+        await write_message(writer, "ok", content[offset:offset + length])
+    else:
+        with blob_store.open(artifact.blob_key) as f:
+            await write_file(writer, "ok", f, offset, length)
+
+'''
+Functions used by the platform
+=========================
+'''
+async def server_hello(writer, zero_trust, payload=b""):
+    if zero_trust:
+        _log_helper("Hello", writer)
+
+    if registry.primary is not None:
+        await write_message(writer, "error", "Read-only replica")
+        return
+
+    # Workers of a multi-process platform wait on a pipe for the writing process, off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, hello_request, _peer_addr(writer), payload)
+    await write_message(writer, "ok")
+
+async def server_discover_products(writer, known_version, zero_trust):
+    if zero_trust:
+        _log_helper("Discovering products", writer)
+
+    await write_message(writer, *registry.discover_response(known_version))
+
+async def platform_discover_registration(writer, data_product_name, zero_trust):
+    if zero_trust:
+        _log_helper("Discovering registration", writer)
+
+    if registry.primary is not None:
+        await write_message(writer, "error", "Read-only replica")
+        return
+
+    registered = await asyncio.get_running_loop().run_in_executor(
+        None, registry.register_product, _peer_addr(writer), *registration_request(data_product_name),
+    )
+    if registered:
+        await write_message(writer, "ok")
+    else:
+        await write_message(writer, "error")
+
+async def server_query_products(writer, query_request, zero_trust):
+    if zero_trust:
+        _log_helper("Querying products", writer)
+
+    await write_message(writer, *query_response(query_request))
+
+async def server_authenticate(writer, action):
+    await write_message(writer, *authentication_response(action, _peer_addr(writer)))
+
+async def server_subscribe(writer, known_version, zero_trust):
+    if zero_trust:
+        _log_helper("Subscribing to marketplace", writer)
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+    overflowed = asyncio.Event()
+
+    def _put(event):
+        try:
+            events.put_nowait(event)
+        except asyncio.QueueFull:
+            overflowed.set()
+
+    def push(event):
+        # Registry changes can come from any thread
+        loop.call_soon_threadsafe(_put, event)
+
+    response = registry.subscribe(push, known_version)
+    try:
+        await write_message(writer, *response)
+        while not overflowed.is_set():
+            try:
+                event = await asyncio.wait_for(events.get(), SUBSCRIPTION_HEARTBEAT)
+            except asyncio.TimeoutError:
+                await write_message(writer, "heartbeat")
+                continue
+            await write_message(writer, "delta", event)
+    finally:
+        registry.unsubscribe(push)
@@ -1,59 +1,72 @@
-import json
+import random
 from .logger import log
+from .connection_pool import pool
+from .instrumentation import metrics
+from .policy import policy
+from .protocol import send_message
+from .sharding import shard_map
+from .tokens import cached_token, issue_token, store_token
+
+def client_authenticate(action):
+    token = cached_token(action)
+    if token is not None:
+        return token
 
-def client_authenticate(action, addr_to_check, domain_client_socket):
     try:
-        with open("src/platform_code/marketplace.json", "r") as f:
-            marketplace = json.load(f)
-        platform_ip = marketplace["platform"]["domain"]
-        
-        domain_client_socket.connect((platform_ip, 9000))
-        domain_client_socket.sendall("authenticate".encode())
-
-        request_received = domain_client_socket.recv(1024).decode()
-        
-        if request_received == "ok":
-            auth_msg = f"{action}/{addr_to_check}"
-            domain_client_socket.sendall(auth_msg.encode())
-            
-            auth_response = domain_client_socket.recv(1024).decode()
-            if auth_response == "ok":
-                return True
-            else:
-                print(f"Authentication failed for action: {action} - response: {auth_response}")
-                return False
+        # Tokens are signed with the shared secret, so any platform node can issue them. Nodes are
+        # tried in random order, so one node that is down only costs a retry
+        nodes = shard_map().all_nodes()
+        random.shuffle(nodes)
+        for platform_ip in nodes:
+            try:
+                auth_response, token = pool.request(platform_ip, "authenticate", action)
+                break
+            except Exception as e:
+                if platform_ip == nodes[-1]:
+                    raise
+                print(f"Error authenticating with {platform_ip}, trying the next node: {e}")
+
+        if auth_response == "ok":
+            token = token.decode()
+            store_token(action, token)
+            return token
         else:
-            print(f"Error in authentication process - response: {request_received}")
-            return False
+            print(f"Authentication failed for action: {action} - response: {auth_response}")
+            return None
     except Exception as e:
         print(f"Exception during authentication: {e}")
-        return False
-    finally:
-        domain_client_socket.close()
-
-def server_authenticate(platform_server_socket):
-    authentication_request = platform_server_socket.recv(1024).decode()
-    if not authentication_request:
-        platform_server_socket.sendall(b"error")
-        return
-
-    action, addr_to_check = authentication_request.split("/")
-    valid_address = True
-    
+        return None
+
+def check_authentication(action, addr_to_check):
+    if not action:
+        return "error"
+
+    # Tokens are not tied to a product, so an address allowed any product gets one and the serving
+    # domain applies the rules for the product
+    valid_address = policy.allowed_any(addr_to_check, action)
+
     if valid_address:
         if action == "discover":
             log("Authentication accept to discover request", addr_to_check)
-            platform_server_socket.sendall(b"ok")
-            return
+            return "ok"
         elif action == "consume":
             log("Authentication accept to consume request", addr_to_check)
-            platform_server_socket.sendall(b"ok")
-            return
+            return "ok"
         else:
             log("Authentication error", addr_to_check)
-            platform_server_socket.sendall(b"error")
-            return
+            return "error"
     else:
         log("Authentication reject", addr_to_check)
-        platform_server_socket.sendall(b"error")
-        return
\ No newline at end of file
+        return "error"
+
+def authentication_response(action, addr_to_check):
+    # Accepted requests get a short-lived token that domains verify locally
+    if check_authentication(action, addr_to_check) == "ok":
+        metrics.add("auth_total", action=action, result="accept")
+        return "ok", issue_token(addr_to_check, action)
+    metrics.add("auth_total", action=action, result="reject")
+    return "error", ""
+
+def server_authenticate(platform_server_socket, action):
+    addr = platform_server_socket.getpeername()[0]
+    send_message(platform_server_socket, *authentication_response(action, addr))
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import struct
+
+_PRODUCT = struct.Struct("!qI")
+# Batched consumes: every product is prefixed with its length, missing products with MISSING
+_BATCH_LENGTH = struct.Struct("!I")
+MISSING = 0xFFFFFFFF
+
+class JsonCodec:
+    name = "json"
+
+    def encode_product(self, product):
+        return json.dumps(product.to_dict()).encode()
+
+    def decode_product(self, payload):
+        return json.loads(payload)
+
+class BinaryCodec:
+    # Numeric fields are packed in columns with struct, names and artifact data follow as one
+    # JSON array without the repeated keys, so encoding and decoding stay in C
+    name = "binary"
+
+    def _columns(self, count):
+        return struct.Struct(f"!{count}q{count}?{count}Q")
+
+    def encode_product(self, product):
+        artifacts = product.artifacts
+        count = len(artifacts)
+        columns = self._columns(count).pack(
+            *[artifact.data_id for artifact in artifacts],
+            *[artifact.blob_key is not None for artifact in artifacts],
+            *[artifact.blob_size for artifact in artifacts],
+        )
+        strings = json.dumps([
+            product.name,
+            product.domain,
+            [artifact.name for artifact in artifacts],
+            [artifact.data for artifact in artifacts],
+        ]).encode()
+        return _PRODUCT.pack(product.data_id, count) + columns + strings
+
+    def decode_product(self, payload):
+        data_id, count = _PRODUCT.unpack_from(payload)
+        columns = self._columns(count)
+        values = columns.unpack_from(payload, _PRODUCT.size)
+        name, domain, names, datas = json.loads(payload[_PRODUCT.size + columns.size:])
+
+        artifacts = []
+        for index in range(count):
+            artifact = {
+                "data_id": values[index],
+                "name": names[index],
+                "data": datas[index],
+            }
+            if values[count + index]:
+                artifact["blob_size"] = values[2 * count + index]
+            artifacts.append(artifact)
+        return {
+            "data_id": data_id,
+            "name": name,
+            "domain": domain,
+            "artifacts": artifacts,
+        }
+
+CODECS = {
+    "binary": BinaryCodec(),
+    "json": JsonCodec(),
+}
+# Offered in order of preference during the handshake
+PREFERRED_CODECS = ["binary", "json"]
+
+def choose_codec(offered):
+    for name in offered:
+        if name in CODECS:
+            return name
+    return "json"
+
+def get_codec(name):
+    return CODECS.get(name, CODECS["json"])
+
+def payload_etag(payload):
+    # Content hash of an encoded product, the consumer computes it from the bytes it received
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def pack_batch(payloads):
+    # Encoded products in request order, None for products the domain does not have
+    parts = []
+    for payload in payloads:
+        if payload is None:
+            parts.append(_BATCH_LENGTH.pack(MISSING))
+        else:
+            parts.append(_BATCH_LENGTH.pack(len(payload)))
+            parts.append(payload)
+    return b"".join(parts)
+
+def unpack_batch(payload):
+    payload = memoryview(payload)
+    payloads = []
+    offset = 0
+    while offset < len(payload):
+        length, = _BATCH_LENGTH.unpack_from(payload, offset)
+        offset += _BATCH_LENGTH.size
+        if length == MISSING:
+            payloads.append(None)
+        else:
+            payloads.append(bytes(payload[offset:offset + length]))
+            offset += length
+    return payloads
@@ -0,0 +1,128 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from config import socket_setup
+from .instrumentation import recorder
+from .protocol import send_message, recv_message
+
+# Servers drop connections that stay idle longer than this
+SERVER_IDLE_TIMEOUT = 60
+# Clients stop reusing connections well before the server would drop them
+CLIENT_IDLE_TIMEOUT = 30
+
+class ServerBusy(Exception):
+    # The server shed the request, the connection can still be used
+    def __init__(self, peer, retry_after):
+        super().__init__(f"{peer} is busy, retry after {retry_after} seconds")
+        self.peer = peer
+        self.retry_after = retry_after
+
+class Connection:
+    def __init__(self, sock, peer):
+        self.sock = sock
+        self.peer = peer
+        self.last_used = time.monotonic()
+
+    def request(self, message_type, payload=b"", read_response=recv_message):
+        start = time.perf_counter()
+        send_message(self.sock, message_type, payload)
+        response, response_payload = read_response(self.sock)
+        if response is None:
+            raise ConnectionError(f"Connection closed by {self.peer[0]}")
+        recorder.record(f"transfer/{message_type}", time.perf_counter() - start, self.peer[0])
+        self.last_used = time.monotonic()
+        if response == "busy":
+            raise ServerBusy(self.peer[0], float(response_payload or 0))
+        return response, response_payload
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    def __init__(self, max_idle_per_peer=8):
+        self.max_idle_per_peer = max_idle_per_peer
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _connect(self, peer):
+        sock = socket_setup(server=False)
+        try:
+            with recorder.time("connect", peer[0]):
+                sock.connect(peer)
+        except Exception:
+            sock.close()
+            raise
+        return Connection(sock, peer)
+
+    def _take_idle(self, peer):
+        with self._lock:
+            idle = self._idle.get(peer)
+            while idle:
+                conn = idle.pop()
+                if time.monotonic() - conn.last_used < CLIENT_IDLE_TIMEOUT:
+                    return conn
+                conn.close()
+        return None
+
+    def _release(self, conn):
+        with self._lock:
+            idle = self._idle.setdefault(conn.peer, [])
+            if len(idle) < self.max_idle_per_peer:
+                idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self, host, port=9000):
+        peer = (host, port)
+        conn = self._take_idle(peer) or self._connect(peer)
+        try:
+            yield conn
+        except ServerBusy:
+            self._release(conn)
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        self._release(conn)
+
+    def request(self, host, message_type, payload=b"", port=9000, read_response=recv_message):
+        peer = (host, port)
+        conn = self._take_idle(peer)
+        if conn is not None:
+            # A pooled connection may have been closed by the peer in the meantime
+            try:
+                response = conn.request(message_type, payload, read_response)
+            except ServerBusy:
+                self._release(conn)
+                raise
+            except (ConnectionError, OSError):
+                conn.close()
+            else:
+                self._release(conn)
+                return response
+
+        conn = self._connect(peer)
+        try:
+            response = conn.request(message_type, payload, read_response)
+        except ServerBusy:
+            self._release(conn)
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        self._release(conn)
+        return response
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+pool = ConnectionPool()
@@ -1,187 +1,603 @@
 import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Local imports
 from .authenticate import client_authenticate
+from .codec import PREFERRED_CODECS, choose_codec, get_codec, pack_batch, payload_etag, unpack_batch
+from .connection_pool import ServerBusy, pool
+from .instrumentation import metrics, recorder
 from .logger import log
-from config import IP_ADDRESSES
+from .peer_selector import selector
+from .policy import policy
+from .product_cache import product_cache
+from .protocol import send_file, send_message, recv_message, recv_header, recv_stream
+from .registry import QUERY_LIMIT, MarketplaceRegistry, Subscription
+from .sharding import shard_map
+from .tokens import verify_token
+from config import socket_setup
 
 def _log_helper(message, socket):
     addr = socket.getpeername()[0]
     log(message, addr)
 
-def _get_platform_ip():
-    with open("src/platform_code/local_db.json", "r") as f:
-        marketplace = json.load(f)
-    return marketplace["platform"]["domain"]
+# Source of truth for the marketplace on the platform, persisted in the background
+registry = MarketplaceRegistry()
 
-def _get_marketplace():
-    with open("src/platform_code/marketplace.json", "r") as f:
-        marketplace = json.load(f)
-    return marketplace
+# Catalog last discovered from each platform shard, refreshed with conditional and delta discovery
+_discovery_caches = {}
+_discovery_lock = threading.Lock()
+# Shards whose subscription has delivered a snapshot
+_subscribed = set()
+
+# Codec agreed on with each domain during the handshake
+_peer_codecs = {}
+
+# Platforms send a heartbeat on idle subscriptions so both sides notice dead connections
+SUBSCRIPTION_HEARTBEAT = 15
+
+# Batched consumes to different domains run concurrently on this many threads
+FAN_OUT_WORKERS = 16
+_fan_out = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix="fan-out")
+
+# Writes only go to a shard's primary, so a busy primary is asked again this many times
+BUSY_RETRIES = 5
 
 '''
 Functions used by the domains
 =========================
 '''
-def client_hello(client_socket):
-        platform_ip = _get_platform_ip()
-        client_socket.connect((platform_ip, 9000))
+def client_hello(data_products=()):
+    # Joins the mesh with all of the domain's products in one round trip per shard. Every primary
+    # replaces what it held for this domain with its share of data_products
+    mesh = shard_map()
+    registrations = {shard: [] for shard in mesh.shards}
+    for data_product in data_products:
+        registrations[mesh.shard_for_product(data_product.name)].append(
+            {"name": data_product.name, "tags": data_product.tags}
+        )
 
-        client_socket.sendall(b"hello")
-        response = client_socket.recv(1024).decode()
+    def hello(shard):
+        payload = json.dumps({"products": registrations[shard]}) if registrations[shard] else b""
+        return _write_request(shard, "hello", payload)[0]
 
-        if response == "ok":
-            hello_success = client_socket.recv(1024)
-            if hello_success == b"ok":
-                return True
-        return False
-        
-def client_discover_products(client_socket):
-    try:
-        platform_ip = _get_platform_ip()
-        client_socket.connect((platform_ip, 9000))
+    return all(response == "ok" for response in _fan_out.map(hello, mesh.shards))
 
-        client_socket.sendall(b"discover")
-        response = client_socket.recv(1024).decode()
-        
-        if response == "ok":
-            products = client_socket.recv(1024).decode()
-            return products
-        elif response.startswith("ok"):
-            products = response[2:]
-            return products
-        else:
-            print("Error in discovering products:", response)
-            return None
+def _write_request(platform_ip, message_type, payload=b""):
+    # Waits for the delay a busy primary asks for, reads fall back to replicas instead
+    for attempt in range(BUSY_RETRIES):
+        try:
+            return pool.request(platform_ip, message_type, payload)
+        except ServerBusy as e:
+            if attempt == BUSY_RETRIES - 1:
+                raise
+            time.sleep(e.retry_after * 2 ** attempt)
+
+def _discovery_cache(shard):
+    # Caller holds the discovery lock
+    return _discovery_caches.setdefault(shard, {"version": "", "products": {}})
+
+def _version_key(version):
+    epoch, _, number = version.partition(":")
+    return epoch, int(number) if number.isdigit() else -1
+
+def _apply_discovery(cache, response, payload):
+    # Caller holds the discovery lock. Concurrent discovers and the subscription may answer out of
+    # order, so only a response that moves the cache forward within its epoch is applied, and
+    # deltas only onto the epoch they were computed in
+    if response == "not_modified":
+        return
+    catalog = json.loads(payload)
+    epoch, number = _version_key(catalog["version"])
+    cached_epoch, cached_number = _version_key(cache["version"])
+    if epoch == cached_epoch and number <= cached_number:
+        return
+    if response != "ok" and epoch != cached_epoch:
+        return
+    if response == "ok":
+        cache["products"] = dict.fromkeys(tuple(pair) for pair in catalog["products"])
+    else:
+        products = cache["products"]
+        for pair in catalog["removed"]:
+            products.pop(tuple(pair), None)
+        for pair in catalog["added"]:
+            products[tuple(pair)] = None
+    cache["version"] = catalog["version"]
+
+def _discovered_products(shards):
+    # Caller holds the discovery lock
+    return [pair for shard in shards for pair in _discovery_cache(shard)["products"]]
+
+def _read_request(shard, message_type, payload=b""):
+    # Replicas share the primary's versions, so any node of the shard can answer
+    nodes = shard_map().read_nodes(shard)
+    for node in nodes:
+        try:
+            return pool.request(node, message_type, payload)
+        except Exception as e:
+            if node == nodes[-1]:
+                raise
+            print(f"Error in {message_type} from {node}, trying the next node: {e}")
+
+def _discover_shard(shard):
+    with _discovery_lock:
+        known_version = _discovery_cache(shard)["version"]
+    response, payload = _read_request(shard, "discover", known_version)
+    if response not in ("ok", "delta", "not_modified"):
+        raise RuntimeError(response)
+    with _discovery_lock:
+        _apply_discovery(_discovery_cache(shard), response, payload)
+
+def client_discover_products():
+    try:
+        shards = shard_map().shards
+        with recorder.time("discover"):
+            # Shards are asked in parallel, results are merged from the per-shard caches
+            list(_fan_out.map(_discover_shard, shards))
+        with _discovery_lock:
+            return _discovered_products(shards)
     except Exception as e:
         print(f"Error in client discover products: {e}")
         return None
-    finally:
-        client_socket.close()
-    
-def client_discover_registration(client_socket, data_product):
+
+def client_query_products(prefix="", pattern=None, domains=None, exclude_domains=None, tags=None,
+                          limit=QUERY_LIMIT, cursor=None):
+    # Returns one page of (product, domain) pairs and the cursor of the next page, None on the last page
+    query = {
+        "prefix": prefix,
+        "pattern": pattern,
+        "domains": domains,
+        "exclude_domains": exclude_domains,
+        "tags": tags,
+        "limit": limit,
+        "cursor": cursor,
+    }
     try:
-        platform_ip = _get_platform_ip()
-        client_socket.connect((platform_ip, 9000))
+        shards = shard_map().shards
+        with recorder.time("discover/query"):
+            responses = list(_fan_out.map(lambda shard: _read_request(shard, "discover/query", json.dumps(query)), shards))
+        products = []
+        more = False
+        for response, payload in responses:
+            if response != "ok":
+                print("Error in querying products:", response)
+                return None, None
+            page = json.loads(payload)
+            products.extend(tuple(product[:2]) for product in page["products"])
+            more = more or page["cursor"] is not None
+        # Every shard pages in the same order, so the merged page continues after its last pair
+        products.sort()
+        more = more or len(products) > limit
+        products = products[:limit]
+        return products, list(products[-1]) if more and products else None
+    except Exception as e:
+        print(f"Error in client query products: {e}")
+        return None, None
 
-        client_socket.sendall(b"discover/registration")
-        response = client_socket.recv(1024).decode()
+def _subscription_loop(shard):
+    while True:
+        subscribe_socket = socket_setup(server=False)
+        subscribe_socket.settimeout(SUBSCRIPTION_HEARTBEAT * 2)
+        try:
+            platform_ip = shard_map().read_nodes(shard)[0]
+            subscribe_socket.connect((platform_ip, 9000))
+            with _discovery_lock:
+                send_message(subscribe_socket, "subscribe", _discovery_cache(shard)["version"])
 
-        if response == "ok":
-            client_socket.sendall(data_product.name.encode())
+            while True:
+                response, payload = recv_message(subscribe_socket)
+                if response is None:
+                    break
+                elif response in ("ok", "delta", "not_modified"):
+                    with _discovery_lock:
+                        _apply_discovery(_discovery_cache(shard), response, payload)
+                        _subscribed.add(shard)
+                elif response != "heartbeat":
+                    print("Error in marketplace subscription:", response)
+                    break
+        except Exception as e:
+            print(f"Error in marketplace subscription: {e}")
+        finally:
+            with _discovery_lock:
+                _subscribed.discard(shard)
+            subscribe_socket.close()
+        time.sleep(1)
+
+def client_subscribe():
+    for shard in shard_map().shards:
+        threading.Thread(target=_subscription_loop, args=(shard,), daemon=True).start()
+
+def subscribed_products():
+    # Live view of the mesh kept up to date by the platform, None until every shard sent a snapshot
+    shards = shard_map().shards
+    with _discovery_lock:
+        if not _subscribed.issuperset(shards):
+            return None
+        return _discovered_products(shards)
 
-            response = client_socket.recv(1024).decode()
-            if response == "ok":
-                return
+def client_discover_registration(data_product):
+    try:
+        platform_ip = shard_map().shard_for_product(data_product.name)
+        registration = json.dumps({"name": data_product.name, "tags": data_product.tags})
+        response, _ = _write_request(platform_ip, "discover/registration", registration)
+        if response == "ok":
+            return
     except Exception as e:
         print(f"Error in client discover registration: {e}")
-    finally:
-        client_socket.close()
 
-def client_consume(client_socket, product_name, product_domain):
+def client_stats(node, request_format="json"):
+    # Live counters, gauges and latency histograms of any platform or domain node
     try:
-        client_socket.connect((product_domain, 9000))
-        client_socket.sendall(b"consume")
-        
-        response = client_socket.recv(1024).decode()
-        if response == "ok":
-            authenticated = client_socket.recv(1024).decode()
-            
-            if authenticated == "ok":
-                client_socket.sendall(product_name.encode())
-                requested_product = client_socket.recv(1024).decode()
-                return requested_product
-            else:
-                print(f"Error in authentication - Auth response: {authenticated}")
+        response, payload = pool.request(node, "stats", request_format)
+        if response != "ok":
+            print(f"Error in client stats - response: {response}")
+            return None
+        return payload.decode() if request_format == "prometheus" else json.loads(payload)
+    except Exception as e:
+        print(f"Error in client stats: {e}")
+        return None
+
+def client_handshake(product_domain):
+    codec = _peer_codecs.get(product_domain)
+    if codec is not None:
+        return codec
+    try:
+        response, codec = pool.request(product_domain, "handshake", json.dumps({"codecs": PREFERRED_CODECS}))
+        codec = codec.decode() if response == "ok" else "json"
+    except Exception as e:
+        print(f"Error in client handshake: {e}")
+        return "json"
+    _peer_codecs[product_domain] = codec
+    return codec
+
+def client_consume(product_name, product_domain, zero_trust=False):
+    # A cached product is sent as its etag, the domain answers not_modified while it is current
+    try:
+        codec = client_handshake(product_domain)
+        consume_request = {"product": product_name, "codec": codec}
+        cached = product_cache.get(product_domain, product_name)
+        if cached is not None:
+            consume_request["etag"] = cached[0]
+        if zero_trust:
+            with recorder.time("authenticate/token"):
+                consume_request["token"] = client_authenticate("consume")
+            if consume_request["token"] is None:
+                selector.release(product_domain)
                 return None
-        
+
+        start = time.perf_counter()
+        response, requested_product = pool.request(product_domain, "consume", json.dumps(consume_request))
+        if response == "not_modified" and cached is not None:
+            selector.record_success(product_domain, time.perf_counter() - start)
+            metrics.add("product_cache_total", result="hit")
+            product_cache.refresh(product_domain, product_name)
+            return cached[1]
+        elif response == "ok":
+            selector.record_success(product_domain, time.perf_counter() - start)
+            metrics.add("product_cache_total", result="miss")
+            with recorder.time("decode", product_domain):
+                product = get_codec(codec).decode_product(requested_product)
+            product_cache.put(product_domain, product_name, payload_etag(requested_product), product)
+            return product
         else:
-            print("Error in consuming data")
+            product_cache.discard(product_domain, product_name)
+            selector.record_failure(product_domain)
+            print(f"Error in consuming data - response: {response} {requested_product.decode()}")
             return None
+    except ServerBusy as e:
+        selector.record_busy(product_domain, e.retry_after)
+        print(f"Error in client consume: {e}")
+        return None
     except ConnectionResetError:
+        selector.record_failure(product_domain)
         print("Connection reset by peer")
         return None
     except Exception as e:
+        selector.record_failure(product_domain)
         print(f"Error in client consume: {e}")
         return None
-    finally:
-        client_socket.close()
-    
-def server_consume(socket_connection, client_socket, products, zero_trust):
-    addr = socket_connection.getpeername()[0]
 
+def client_consume_batch(product_names, product_domain, zero_trust=False):
+    # Several products from one domain in a single round trip, products it does not have are left out
+    try:
+        codec = client_handshake(product_domain)
+        batch_request = {"products": list(product_names), "codec": codec}
+        if zero_trust:
+            with recorder.time("authenticate/token"):
+                batch_request["token"] = client_authenticate("consume")
+            if batch_request["token"] is None:
+                selector.release(product_domain)
+                return None
+
+        start = time.perf_counter()
+        response, payload = pool.request(product_domain, "consume/batch", json.dumps(batch_request))
+        if response == "ok":
+            selector.record_success(product_domain, time.perf_counter() - start)
+            with recorder.time("decode", product_domain):
+                decoder = get_codec(codec)
+                return {
+                    name: decoder.decode_product(product)
+                    for name, product in zip(batch_request["products"], unpack_batch(payload))
+                    if product is not None
+                }
+        else:
+            selector.record_failure(product_domain)
+            print(f"Error in consuming batch - response: {response} {payload.decode()}")
+            return None
+    except ServerBusy as e:
+        selector.record_busy(product_domain, e.retry_after)
+        print(f"Error in client consume batch: {e}")
+        return None
+    except Exception as e:
+        selector.record_failure(product_domain)
+        print(f"Error in client consume batch: {e}")
+        return None
+
+def client_consume_many(products, zero_trust=False):
+    # products are (product, domain) pairs, one batched request per domain, all domains in parallel
+    by_domain = {}
+    for product_name, product_domain in products:
+        by_domain.setdefault(product_domain, []).append(product_name)
+
+    futures = {
+        product_domain: _fan_out.submit(client_consume_batch, product_names, product_domain, zero_trust)
+        for product_domain, product_names in by_domain.items()
+    }
+    consumed = {}
+    for product_domain, future in futures.items():
+        for product_name, product in (future.result() or {}).items():
+            consumed[product_name, product_domain] = product
+    return consumed
+
+def client_consume_artifact(product_name, artifact_name, product_domain, offset=0, length=None,
+                            zero_trust=False, destination=None):
+    # Streams the artifact (or a byte range of it) into destination when given, else returns the bytes
+    def read_artifact(sock):
+        response, size = recv_header(sock)
+        if response is None:
+            return None, None
+        try:
+            if response != "ok" or destination is None:
+                return response, b"".join(recv_stream(sock, size))
+            for chunk in recv_stream(sock, size):
+                destination.write(chunk)
+            return response, size
+        except OSError as e:
+            # Part of the artifact may already be written, so this must not be retried
+            raise RuntimeError(f"Artifact transfer interrupted: {e}") from e
+
+    try:
+        artifact_request = {"product": product_name, "artifact": artifact_name, "offset": offset, "length": length}
+        if zero_trust:
+            artifact_request["token"] = client_authenticate("consume")
+            if artifact_request["token"] is None:
+                return None
+
+        response, artifact = pool.request(product_domain, "consume/artifact", json.dumps(artifact_request),
+                                          read_response=read_artifact)
+        if response == "ok":
+            return artifact
+        else:
+            print(f"Error in consuming artifact - response: {response} {artifact.decode()}")
+            return None
+    except Exception as e:
+        print(f"Error in client consume artifact: {e}")
+        return None
+
+def consume_allowed(addr, zero_trust, token=None, product=None):
+    # A token proves the platform let addr consume, the rules for the product are checked here
     if zero_trust:
-        if not client_authenticate("consume", addr, client_socket):
-            socket_connection.sendall(b"error")
-            return
-        socket_connection.sendall(b"ok")
+        with recorder.time("authenticate/verify", addr):
+            allowed = verify_token(token, "consume", addr)
+        allowed = allowed and (product is None or policy.allowed(addr, "consume", product))
     else:
-        valid_ips = IP_ADDRESSES
-        if addr in valid_ips:
-            socket_connection.sendall(b"ok")
-        else:
-            socket_connection.sendall(b"error")
-            return
+        allowed = policy.allowed(addr, "consume", product)
+    metrics.add("auth_total", action="consume", result="accept" if allowed else "reject")
+    return allowed
+
+def consume_response(products, consume_request):
+    # The product store keeps the encoded product until it changes
+    codec = get_codec(consume_request.get("codec", "json"))
+    etag, payload = products.versioned(consume_request["product"], codec)
+    if payload is None:
+        return "error", "Product not found"
+    if consume_request.get("etag") == etag:
+        return "not_modified", b""
+    return "ok", payload
+
+def consume_batch_response(products, batch_request, addr=None):
+    # Products the policy denies to addr are left out like unknown ones
+    codec = get_codec(batch_request.get("codec", "json"))
+    return "ok", pack_batch([
+        products.encoded(name, codec) if addr is None or policy.allowed(addr, "consume", name) else None
+        for name in batch_request["products"]
+    ])
+
+def stats_response(request_format):
+    if request_format == "prometheus":
+        return "ok", metrics.prometheus()
+    return "ok", json.dumps(metrics.snapshot())
+
+def server_stats(socket_connection, request_format):
+    send_message(socket_connection, *stats_response(request_format))
+
+def server_handshake(socket_connection, handshake_request):
+    send_message(socket_connection, "ok", choose_codec(handshake_request.get("codecs", [])))
+
+def server_consume(socket_connection, products, zero_trust, consume_request):
+    addr = socket_connection.getpeername()[0]
+
+    if not consume_allowed(addr, zero_trust, consume_request.get("token"), consume_request["product"]):
+        send_message(socket_connection, "error", "Not authenticated")
+        return
+
+    send_message(socket_connection, *consume_response(products, consume_request))
+
+def server_consume_batch(socket_connection, products, zero_trust, batch_request):
+    addr = socket_connection.getpeername()[0]
+
+    if not consume_allowed(addr, zero_trust, batch_request.get("token")):
+        send_message(socket_connection, "error", "Not authenticated")
+        return
 
-    dataproduct_request = socket_connection.recv(1024).decode()
-    
-    for product in products:
-        if product.name == dataproduct_request:
-            product_dict = product.to_dict()
-            json_str = json.dumps(product_dict)
-            socket_connection.sendall(json_str.encode())
-            break
+    send_message(socket_connection, *consume_batch_response(products, batch_request, addr))
+
+def artifact_range(products, blob_store, artifact_request):
+    product = products.get(artifact_request["product"])
+    if product is None:
+        return "Product not found", None, 0, 0
+    artifact = product.get_artifact(artifact_request["artifact"])
+    if artifact is None:
+        return "Artifact not found", None, 0, 0
+
+    offset = artifact_request.get("offset") or 0
+    length = artifact_request.get("length")
+    if artifact.blob_key is None:
+        size = len(json.dumps(artifact.data).encode())
+    else:
+        size = blob_store.size(artifact.blob_key)
+    offset = min(max(offset, 0), size)
+    if length is None:
+        length = size - offset
+    return None, artifact, offset, min(max(length, 0), size - offset)
+
+def server_consume_artifact(socket_connection, products, blob_store, zero_trust, artifact_request):
+    addr = socket_connection.getpeername()[0]
+
+    if not consume_allowed(addr, zero_trust, artifact_request.get("token"), artifact_request["product"]):
+        send_message(socket_connection, "error", "Not authenticated")
+        return
+
+    error, artifact, offset, length = artifact_range(products, blob_store, artifact_request)
+    if error is not None:
+        send_message(socket_connection, "error", error)
+    elif artifact.blob_key is None:
+        content = memoryview(json.dumps(artifact.data).encode())
+        send_message(socket_connection, "ok", content[offset:offset + length])
     else:
-        socket_connection.sendall(b"error")
+        with blob_store.open(artifact.blob_key) as f:
+            send_file(socket_connection, "ok", f, offset, length)
 
 '''
 Functions used by the platform
 =========================
 '''
 
-def server_hello(socket_connection, zero_trust):
+def register_marketplace_gauges():
+    metrics.gauge("marketplace_products", registry.product_count)
+    metrics.gauge("marketplace_domains", registry.domain_count)
+    metrics.gauge("subscriptions_active", registry.subscriber_count)
+
+def hello_request(addr, payload):
+    # A hello may carry the domain's products, then they are registered along with it
+    if payload:
+        registry.join_domain(addr, json.loads(payload)["products"])
+    else:
+        registry.add_domain(addr)
+
+def server_hello(socket_connection, zero_trust, payload=b""):
     if zero_trust:
         _log_helper("Hello", socket_connection)
 
-    marketplace = _get_marketplace()
+    if registry.primary is not None:
+        send_message(socket_connection, "error", "Read-only replica")
+        return
 
     addr = socket_connection.getpeername()[0]
-    if addr not in marketplace:
-        marketplace[addr] = {
-            "domain": addr,
-            "products": []
-        }
-        with open("src/platform_code/marketplace.json", "w") as f:
-            json.dump(marketplace, f, indent=4)
-    socket_connection.sendall(b"ok")
-
-def server_discover_products(socket_connection, zero_trust):
+    hello_request(addr, payload)
+    send_message(socket_connection, "ok")
+
+def server_discover_products(socket_connection, known_version, zero_trust):
     if zero_trust:
         _log_helper("Discovering products", socket_connection)
 
-    marketplace = _get_marketplace()
-
-    product_domain_pairs = []
-    for domain in marketplace:
-        if domain != "platform":
-            for product in marketplace[domain]["products"]:
-                product_domain_pairs.append((product, domain))
-    json_data = json.dumps(product_domain_pairs).encode()
-    socket_connection.sendall(json_data)
-            
-def platform_discover_registration(socket_connection, zero_trust):
+    send_message(socket_connection, *registry.discover_response(known_version))
+
+def registration_request(payload):
+    # Registrations are JSON with the product name and tags, older domains send only the name
+    try:
+        registration = json.loads(payload)
+    except ValueError:
+        registration = None
+    if not isinstance(registration, dict):
+        return payload, []
+    return registration["name"], registration.get("tags") or []
+
+def query_response(query_request):
+    return "ok", json.dumps(registry.query(
+        prefix=query_request.get("prefix") or "",
+        pattern=query_request.get("pattern"),
+        domains=query_request.get("domains"),
+        exclude_domains=query_request.get("exclude_domains"),
+        tags=query_request.get("tags"),
+        limit=query_request.get("limit") or QUERY_LIMIT,
+        cursor=query_request.get("cursor"),
+    )).encode()
+
+def platform_discover_registration(socket_connection, data_product_name, zero_trust):
     if zero_trust:
         _log_helper("Discovering registration", socket_connection)
 
-    marketplace = _get_marketplace()
+    if registry.primary is not None:
+        send_message(socket_connection, "error", "Read-only replica")
+        return
 
-    data_product_name = socket_connection.recv(1024).decode()
     addr = socket_connection.getpeername()[0]
-    if addr in marketplace:
-        if data_product_name not in marketplace[addr]["products"]:
-            marketplace[addr]["products"].append(data_product_name)
-        with open("src/platform_code/marketplace.json", "w") as f:
-            json.dump(marketplace, f, indent=4)
-        socket_connection.sendall(b"ok")
+    if registry.register_product(addr, *registration_request(data_product_name)):
+        send_message(socket_connection, "ok")
     else:
-        socket_connection.sendall(b"error")
+        send_message(socket_connection, "error")
+
+def server_query_products(socket_connection, query_request, zero_trust):
+    if zero_trust:
+        _log_helper("Querying products", socket_connection)
+
+    send_message(socket_connection, *query_response(query_request))
+
+def server_subscribe(socket_connection, known_version, zero_trust):
+    if zero_trust:
+        _log_helper("Subscribing to marketplace", socket_connection)
+
+    subscription = Subscription()
+    response = registry.subscribe(subscription.push, known_version)
+    try:
+        send_message(socket_connection, *response)
+        while not subscription.overflowed:
+            try:
+                event = subscription.events.get(timeout=SUBSCRIPTION_HEARTBEAT)
+            except queue.Empty:
+                send_message(socket_connection, "heartbeat")
+                continue
+            send_message(socket_connection, "delta", event)
+    finally:
+        registry.unsubscribe(subscription.push)
+
+def _replication_loop(primary_ip):
+    while True:
+        replication_socket = socket_setup(server=False)
+        replication_socket.settimeout(SUBSCRIPTION_HEARTBEAT * 2)
+        try:
+            replication_socket.connect((primary_ip, 9000))
+            send_message(replication_socket, "subscribe", registry.version())
+
+            while True:
+                response, payload = recv_message(replication_socket)
+                if response is None:
+                    break
+                elif response in ("ok", "delta", "not_modified"):
+                    registry.replicate(response, payload)
+                elif response != "heartbeat":
+                    print("Error in marketplace replication:", response)
+                    break
+        except Exception as e:
+            print(f"Error in marketplace replication: {e}")
+        finally:
+            replication_socket.close()
+        time.sleep(1)
+
+def platform_follow(primary_ip):
+    # Runs this platform as a read replica of primary_ip, serving discovery and tokens only
+    registry.primary = primary_ip
+    threading.Thread(target=_replication_loop, args=(primary_ip,), daemon=True).start()
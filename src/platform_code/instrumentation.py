@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Values are kept in microseconds, exact below 2^SUB_BUCKET_BITS and within 1% above
+SUB_BUCKET_BITS = 8
+_SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+_HALF_BUCKETS = _SUB_BUCKETS >> 1
+
+def _bucket_index(value):
+    if value < _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return _SUB_BUCKETS + (shift - 1) * _HALF_BUCKETS + ((value >> shift) - _HALF_BUCKETS)
+
+def _bucket_value(index):
+    # Highest value that falls into the bucket, so percentiles never understate latency
+    if index < _SUB_BUCKETS:
+        return index
+    shift = (index - _SUB_BUCKETS) // _HALF_BUCKETS + 1
+    top = (index - _SUB_BUCKETS) % _HALF_BUCKETS + _HALF_BUCKETS
+    return ((top + 1) << shift) - 1
+
+class Histogram:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(int(seconds * 1_000_000), 0)
+        index = _bucket_index(value)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        with other._lock:
+            counts = dict(other.counts)
+            count, total, maximum = other.count, other.total, other.max
+        with self._lock:
+            for index, bucket_count in counts.items():
+                self.counts[index] = self.counts.get(index, 0) + bucket_count
+            self.count += count
+            self.total += total
+            self.max = max(self.max, maximum)
+
+    def percentile(self, percentile):
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            target = max(1, int(round(percentile / 100 * self.count)))
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                if seen >= target:
+                    return min(_bucket_value(index), self.max) / 1_000_000
+            return self.max / 1_000_000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count / 1_000_000 if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max / 1_000_000,
+        }
+
+class LatencyRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (phase, peer) -> Histogram
+        self._histograms = {}
+        self._stopped = threading.Event()
+        self._flusher = None
+
+    def record(self, phase, seconds, peer=None):
+        key = (phase, peer)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.record(seconds)
+
+    @contextmanager
+    def time(self, phase, peer=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start, peer)
+
+    def snapshot(self):
+        # Per phase: every peer on its own plus all peers combined
+        with self._lock:
+            histograms = list(self._histograms.items())
+        phases = {}
+        combined = {}
+        for (phase, peer), histogram in histograms:
+            if peer is not None:
+                phases.setdefault(phase, {})[peer] = histogram.summary()
+            combined.setdefault(phase, Histogram()).merge(histogram)
+        for phase, histogram in combined.items():
+            phases.setdefault(phase, {})["all"] = histogram.summary()
+        return phases
+
+    def flush(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=4)
+        os.replace(tmp_path, path)
+
+    def _flush_loop(self, path, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.flush(path)
+            except Exception as e:
+                print(f"Error flushing latency histograms: {e}")
+
+    def start(self, path, interval=10):
+        self._flusher = threading.Thread(target=self._flush_loop, args=(path, interval), daemon=True)
+        self._flusher.start()
+
+    def stop(self, path):
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush(path)
+
+recorder = LatencyRecorder()
+
+'''
+Live counters and gauges
+=========================
+'''
+COUNTER = "counter"
+GAUGE = "gauge"
+
+# Prefix of every metric in the Prometheus text format
+METRIC_PREFIX = "data_mesh_"
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def _label_key(labels):
+    return ",".join(f'{name}="{_label_value(value)}"' for name, value in sorted(labels.items()))
+
+class Metrics:
+    # Every thread counts into its own dict, so counting takes no lock. A snapshot sums the dicts.
+    # The dicts of threads that ended are folded into one, so short-lived threads do not pile up
+    def __init__(self):
+        self._local = threading.local()
+        # (owning thread, values) pairs
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._retired = {}
+        self._gauges = {}
+
+    def _fold_finished(self):
+        # Caller holds _shards_lock. A thread that ended no longer writes to its dict
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+            for key, value in shard.items():
+                self._retired[key] = self._retired.get(key, 0) + value
+        self._shards = live
+
+    def _shard(self):
+        shard = getattr(self._local, "values", None)
+        if shard is None:
+            shard = self._local.values = {}
+            with self._shards_lock:
+                self._fold_finished()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def add(self, name, value=1, **labels):
+        key = (COUNTER, name, _label_key(labels))
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + value
+
+    def adjust(self, name, delta, **labels):
+        # Gauges that go up and down, like open connections
+        key = (GAUGE, name, _label_key(labels))
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + delta
+
+    def gauge(self, name, read):
+        # read() is called on every snapshot, for values other modules already keep
+        self._gauges[name] = read
+
+    def values(self):
+        with self._shards_lock:
+            self._fold_finished()
+            shards = [self._retired.copy()] + [shard for _, shard in self._shards]
+        totals = {COUNTER: {}, GAUGE: {}}
+        for shard in shards:
+            # Copying a dict is atomic, the owning thread may keep counting meanwhile
+            for (kind, name, labels), value in shard.copy().items():
+                metric = totals[kind].setdefault(name, {})
+                metric[labels] = metric.get(labels, 0) + value
+        for name, read in list(self._gauges.items()):
+            try:
+                totals[GAUGE][name] = {"": read()}
+            except Exception as e:
+                print(f"Error reading gauge {name}: {e}")
+        return totals
+
+    def snapshot(self, latency=recorder):
+        totals = self.values()
+        return {"counters": totals[COUNTER], "gauges": totals[GAUGE], "latency": latency.snapshot()}
+
+    def prometheus(self, latency=recorder):
+        # Text exposition format, latency histograms become summaries over all peers
+        lines = []
+        totals = self.values()
+        for kind in (COUNTER, GAUGE):
+            for name, series in sorted(totals[kind].items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{METRIC_PREFIX}{name}{{{labels}}} {value}" if labels else f"{METRIC_PREFIX}{name} {value}")
+        lines.append(f"# TYPE {METRIC_PREFIX}latency_seconds summary")
+        for phase, peers in sorted(latency.snapshot().items()):
+            summary = peers["all"]
+            label = f'phase="{phase}"'
+            for key, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                lines.append(f'{METRIC_PREFIX}latency_seconds{{{label},quantile="{quantile}"}} {summary[key]}')
+            lines.append(f"{METRIC_PREFIX}latency_seconds_sum{{{label}}} {summary['mean'] * summary['count']}")
+            lines.append(f"{METRIC_PREFIX}latency_seconds_count{{{label}}} {summary['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
@@ -1,16 +1,204 @@
 import datetime
+import queue
+import struct
+import threading
+import time
+
+LOG_PATH = "src/platform_code/log.csv"
+BINARY_LOG_PATH = "src/platform_code/log.bin"
+STRINGS_PATH = "src/platform_code/log.strings"
+
+LOG_QUEUE_SIZE = 100_000
+LOG_BATCH_SIZE = 1_000
+LOG_FLUSH_INTERVAL = 0.5
+
+# Binary records: timestamp, domain string index, message string index. Indices are 32 bits, so
+# the string table is not limited by the number of domains a long run sees
+RECORD = struct.Struct("!dII")
+
+_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+_log_format = "csv"
+_dropped = 0
+# Set in pre-forked platform workers, batches go to the parent process instead of a file
+_forward_queue = None
+
+def set_log_format(log_format):
+    global _log_format
+    if log_format not in ("csv", "binary"):
+        raise ValueError(f"Unknown log format: {log_format}")
+    _log_format = log_format
 
 def reset_log_file():
     try:
-        with open("src/platform_code/log.csv", 'w') as log_file:
-            log_file.write("")
+        for path in (LOG_PATH, BINARY_LOG_PATH, STRINGS_PATH):
+            with open(path, 'w') as log_file:
+                log_file.write("")
     except Exception as e:
         print(f"Error resetting log file: {e}")
 
 def log(message, domain):
+    # Only enqueues, formatting and writing happens on the background writer
+    _enqueue((time.time(), domain, message))
+
+def _enqueue(entry):
+    global _dropped
+    if _writer is None:
+        _start_writer()
     try:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
-        with open("src/platform_code/log.csv", 'a') as log_file:
-            log_file.write(f"{timestamp};{domain};{message}\n")
-    except Exception as e:
-        print(f"Error writing to log file: {e}")
\ No newline at end of file
+        _queue.put_nowait(entry)
+    except queue.Full:
+        _dropped += 1
+
+def forward_to(target_queue):
+    # Call before the first log, batches are put on target_queue for another process to write
+    global _forward_queue
+    _forward_queue = target_queue
+
+def receive_forwarded(source_queue):
+    # Writes the batches forwarded by other processes to this process's log
+    def _receive():
+        while True:
+            entries = source_queue.get()
+            if entries is None:
+                break
+            for entry in entries:
+                _enqueue(entry)
+    threading.Thread(target=_receive, daemon=True).start()
+
+def dropped_count():
+    return _dropped
+
+'''
+Background writer
+=========================
+'''
+class _CsvWriter:
+    def __init__(self):
+        self.file = open(LOG_PATH, 'a')
+
+    def write(self, entries):
+        lines = []
+        for timestamp, domain, message in entries:
+            formatted = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d, %H:%M:%S")
+            lines.append(f"{formatted};{domain};{message}\n")
+        self.file.write("".join(lines))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class _BinaryWriter:
+    def __init__(self):
+        self.strings = {string: index for index, string in enumerate(read_strings())}
+        self.file = open(BINARY_LOG_PATH, 'ab')
+        self.strings_file = open(STRINGS_PATH, 'a')
+
+    def _index(self, string):
+        index = self.strings.get(string)
+        if index is None:
+            index = len(self.strings)
+            self.strings[string] = index
+            self.strings_file.write(f"{string}\n")
+            self.strings_file.flush()
+        return index
+
+    def write(self, entries):
+        records = bytearray()
+        for timestamp, domain, message in entries:
+            records += RECORD.pack(timestamp, self._index(str(domain)), self._index(message))
+        self.file.write(records)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        self.strings_file.close()
+
+class _ForwardWriter:
+    def __init__(self, target_queue):
+        self.target_queue = target_queue
+
+    def write(self, entries):
+        self.target_queue.put(entries)
+
+    def close(self):
+        pass
+
+def _write_loop():
+    if _forward_queue is not None:
+        writer = _ForwardWriter(_forward_queue)
+    elif _log_format == "binary":
+        writer = _BinaryWriter()
+    else:
+        writer = _CsvWriter()
+    try:
+        while True:
+            entry = _queue.get()
+            if entry is None:
+                break
+            entries = [entry]
+            stop = False
+            while len(entries) < LOG_BATCH_SIZE:
+                try:
+                    entry = _queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                entries.append(entry)
+            try:
+                writer.write(entries)
+            except Exception as e:
+                print(f"Error writing to log file: {e}")
+            if stop:
+                break
+            if len(entries) < LOG_BATCH_SIZE:
+                # Let a few more entries queue up before the next write
+                time.sleep(LOG_FLUSH_INTERVAL)
+    finally:
+        writer.close()
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, daemon=True)
+            _writer.start()
+
+def stop():
+    # Writes everything still queued before returning
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            return
+        _queue.put(None)
+        _writer.join()
+        _writer = None
+
+'''
+Reading the binary log
+=========================
+'''
+def read_strings(path=STRINGS_PATH):
+    try:
+        with open(path, 'r') as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+def iter_binary_records(path=BINARY_LOG_PATH, chunk_records=65_536):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(RECORD.size * chunk_records)
+            if not chunk:
+                break
+            yield from RECORD.iter_unpack(chunk[:len(chunk) - len(chunk) % RECORD.size])
+
+def export_csv(binary_path=BINARY_LOG_PATH, strings_path=STRINGS_PATH, csv_path=LOG_PATH):
+    strings = read_strings(strings_path)
+    with open(csv_path, 'w') as f:
+        for timestamp, domain, message in iter_binary_records(binary_path):
+            formatted = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d, %H:%M:%S")
+            f.write(f"{formatted};{strings[domain]};{strings[message]}\n")
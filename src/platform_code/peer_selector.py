@@ -0,0 +1,176 @@
+import random
+import threading
+import time
+
+# Weight of the newest sample in the latency and error averages
+EWMA_ALPHA = 0.3
+# Each unit of error rate counts as this many times the peer's latency
+ERROR_PENALTY = 10
+# Peers without a sample for this long are probed again, so a recovered peer gets picked up
+PROBE_INTERVAL = 10.0
+
+# Consecutive failures that open the circuit of a peer
+FAILURE_THRESHOLD = 3
+# Open circuits wait BACKOFF_BASE, doubling on every failed probe up to BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# How long to wait for a probe in flight before asking again
+PROBE_WAIT = 0.1
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class PeerStats:
+    __slots__ = ("latency", "error_rate", "last_sample", "failures", "state", "trips", "open_until", "probing")
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.last_sample = 0.0
+        self.failures = 0
+        self.state = CLOSED
+        self.trips = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def score(self, now):
+        if self.latency is None or now - self.last_sample > PROBE_INTERVAL:
+            return 0.0
+        return self.latency * (1 + ERROR_PENALTY * self.error_rate)
+
+    def to_dict(self):
+        return {
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "state": self.state,
+            "trips": self.trips,
+        }
+
+class PeerSelector:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._peers = {}
+        self._random = random.Random()
+
+    def _stats(self, peer):
+        stats = self._peers.get(peer)
+        if stats is None:
+            stats = self._peers[peer] = PeerStats()
+        return stats
+
+    def _available(self, stats, now):
+        # Caller holds the lock, an expired open circuit lets a single probe through
+        if stats.state == OPEN and now >= stats.open_until:
+            stats.state = HALF_OPEN
+            stats.probing = False
+        if stats.state == HALF_OPEN:
+            return not stats.probing
+        return stats.state == CLOSED
+
+    def _best(self, domains, now):
+        # Caller holds the lock
+        candidates = [(self._stats(domain), domain) for domain in domains]
+        candidates = [(stats, domain) for stats, domain in candidates if self._available(stats, now)]
+        if not candidates:
+            return None
+        # Shuffle first so equally scored replicas share the load
+        self._random.shuffle(candidates)
+        stats, domain = min(candidates, key=lambda candidate: candidate[0].score(now))
+        if stats.state == HALF_OPEN:
+            stats.probing = True
+        return domain
+
+    def _replicas(self, products):
+        replicas = {}
+        for product, domain in products:
+            replicas.setdefault(product, []).append(domain)
+        return replicas
+
+    def choose(self, products, sequence=0):
+        # products are (product, domain) pairs, products are taken round-robin by name and
+        # each one is served by its fastest available replica
+        replicas = self._replicas(products)
+        names = sorted(replicas)
+        now = time.monotonic()
+        with self._lock:
+            for offset in range(len(names)):
+                name = names[(sequence + offset) % len(names)]
+                domain = self._best(replicas[name], now)
+                if domain is not None:
+                    return name, domain
+        return None
+
+    def choose_all(self, products):
+        # The fastest available replica of every product name, for assembling a view
+        now = time.monotonic()
+        chosen = []
+        with self._lock:
+            for name, domains in sorted(self._replicas(products).items()):
+                domain = self._best(domains, now)
+                if domain is not None:
+                    chosen.append((name, domain))
+        return chosen
+
+    def retry_delay(self, products):
+        # Time until one of the domains can be tried again, 0 when one is available now
+        now = time.monotonic()
+        with self._lock:
+            delays = []
+            for _, domain in products:
+                stats = self._stats(domain)
+                if self._available(stats, now):
+                    return 0.0
+                if stats.state == HALF_OPEN:
+                    delays.append(PROBE_WAIT)
+                else:
+                    delays.append(max(stats.open_until - now, 0.0))
+        return min(delays) if delays else 0.0
+
+    def record_success(self, peer, seconds):
+        with self._lock:
+            stats = self._stats(peer)
+            if stats.latency is None:
+                stats.latency = seconds
+            else:
+                stats.latency += EWMA_ALPHA * (seconds - stats.latency)
+            stats.error_rate -= EWMA_ALPHA * stats.error_rate
+            stats.last_sample = time.monotonic()
+            stats.failures = 0
+            stats.state = CLOSED
+            stats.trips = 0
+            stats.probing = False
+
+    def record_failure(self, peer):
+        with self._lock:
+            stats = self._stats(peer)
+            stats.error_rate += EWMA_ALPHA * (1 - stats.error_rate)
+            stats.last_sample = time.monotonic()
+            stats.failures += 1
+            stats.probing = False
+            if stats.state == HALF_OPEN or stats.failures >= FAILURE_THRESHOLD:
+                stats.trips += 1
+                backoff = min(BACKOFF_BASE * 2 ** (stats.trips - 1), BACKOFF_MAX)
+                # Jitter keeps domains from probing a recovering peer all at once
+                stats.open_until = time.monotonic() + backoff * self._random.uniform(0.8, 1.2)
+                stats.state = OPEN
+
+    def record_busy(self, peer, retry_after):
+        # A peer that sheds load is healthy but full. It is skipped for the delay it asked for,
+        # without counting towards opening its circuit
+        with self._lock:
+            stats = self._stats(peer)
+            stats.probing = False
+            stats.open_until = max(stats.open_until, time.monotonic() + retry_after)
+            stats.state = OPEN
+
+    def release(self, peer):
+        # The caller chose the peer but sent it nothing, so a probe it was given goes to the next caller
+        with self._lock:
+            self._stats(peer).probing = False
+
+    def snapshot(self):
+        with self._lock:
+            return {peer: stats.to_dict() for peer, stats in self._peers.items()}
+
+selector = PeerSelector()
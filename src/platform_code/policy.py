@@ -0,0 +1,206 @@
+import functools
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+
+from config import IP_ADDRESSES
+
+POLICY_PATH = os.environ.get("DATA_MESH_POLICY", "src/platform_code/policy.json")
+# How often the policy file is checked for changes
+RELOAD_INTERVAL = 1.0
+
+# Matches any action or any product
+ANY = "*"
+# Exact addresses rank above every CIDR range
+_EXACT = 129
+# Decisions remembered per compiled policy, domains ask about the same few peers over and over
+DECISION_CACHE_SIZE = 65_536
+
+@functools.lru_cache(maxsize=4096)
+def _parse(addr):
+    # (IP version, address as an integer, address width), None for names that are not addresses
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return None
+    return ip.version, int(ip), ip.max_prefixlen
+
+def _resolve(entry):
+    # Addresses and CIDR ranges as networks, host names as the addresses they resolve to
+    try:
+        return [ipaddress.ip_network(entry, strict=False)]
+    except ValueError:
+        pass
+    try:
+        infos = socket.getaddrinfo(entry, None, proto=socket.IPPROTO_TCP)
+    except OSError as e:
+        print(f"Policy entry {entry} does not resolve: {e}")
+        return []
+    return [ipaddress.ip_network(info[4][0]) for info in infos]
+
+class PrefixTrie:
+    # Binary trie over the address bits, a lookup walks at most one node per bit of the address
+    def __init__(self):
+        # Children for bit 0 and bit 1, and whether the prefix ending here is allowed
+        self._root = [None, None, None]
+
+    def insert(self, network, allow):
+        node = self._root
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+        for index in range(network.prefixlen):
+            bit = (bits >> (width - 1 - index)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        # A deny for the same prefix wins over an allow
+        node[2] = allow if node[2] is None else node[2] and allow
+
+    def longest_match(self, bits, width):
+        # (prefix length, allowed) of the longest matching prefix, or None
+        node = self._root
+        best = None
+        for index in range(width + 1):
+            if node[2] is not None:
+                best = (index, node[2])
+            if index == width:
+                break
+            node = node[(bits >> (width - 1 - index)) & 1]
+            if node is None:
+                break
+        return best
+
+class RuleTable:
+    # Rules for one action and product: exact addresses in a hash index, ranges in a trie per IP version
+    def __init__(self):
+        self.exact = {}
+        self.tries = {4: PrefixTrie(), 6: PrefixTrie()}
+
+    def add(self, network, allow):
+        if network.prefixlen == network.max_prefixlen:
+            addr = str(network.network_address)
+            self.exact[addr] = allow if addr not in self.exact else self.exact[addr] and allow
+        else:
+            self.tries[network.version].insert(network, allow)
+
+    def match(self, addr, parsed):
+        allow = self.exact.get(addr)
+        if allow is not None:
+            return _EXACT, allow
+        if parsed is None:
+            return None
+        version, bits, width = parsed
+        return self.tries[version].longest_match(bits, width)
+
+class CompiledPolicy:
+    def __init__(self, policy):
+        self.default_allow = policy.get("default", "deny") == "allow"
+        self._tables = {}
+        self._decisions = {}
+        # Products that have rules of their own
+        self._products = set()
+        for rule in policy.get("rules", []):
+            allow = rule.get("effect", "allow") == "allow"
+            networks = [network for entry in rule.get("domains", []) for network in _resolve(entry)]
+            for action in rule.get("actions") or [ANY]:
+                for product in rule.get("products") or [ANY]:
+                    if product != ANY:
+                        self._products.add(product)
+                    table = self._tables.setdefault((action, product), RuleTable())
+                    for network in networks:
+                        table.add(network, allow)
+
+    def _best(self, addr, parsed, action, product):
+        # Longer prefixes win, then rules for the exact action, then deny
+        best = None
+        for action_specific, key in ((True, (action, product)), (False, (ANY, product))):
+            table = self._tables.get(key)
+            match = table.match(addr, parsed) if table is not None else None
+            if match is not None:
+                prefix, allow = match
+                candidate = (prefix, action_specific, not allow)
+                if best is None or candidate > best:
+                    best = candidate
+        return best
+
+    def _decide(self, addr, action, product):
+        parsed = _parse(addr)
+        # Rules for the product come before rules for every product
+        best = None
+        if product is not None:
+            best = self._best(addr, parsed, action, product)
+        if best is None:
+            best = self._best(addr, parsed, action, ANY)
+        if best is None:
+            return self.default_allow
+        return not best[2]
+
+    def allowed(self, addr, action, product=None):
+        key = (addr, action, product)
+        decision = self._decisions.get(key)
+        if decision is None:
+            decision = self._decide(addr, action, product)
+            if len(self._decisions) >= DECISION_CACHE_SIZE:
+                self._decisions.clear()
+            self._decisions[key] = decision
+        return decision
+
+    def allowed_any(self, addr, action):
+        # Whether addr may perform the action on at least one product
+        return self.allowed(addr, action) or any(self.allowed(addr, action, product) for product in self._products)
+
+def default_policy():
+    # Without a policy file the addresses in config.py may do anything
+    return {"default": "deny", "rules": [{"effect": "allow", "domains": IP_ADDRESSES}]}
+
+class PolicyEngine:
+    # Reloads the policy file when it changes, requests in flight keep the policy they started with
+    def __init__(self, path=POLICY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._compiled = None
+        self._mtime = None
+        self._checked = 0.0
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._compiled is not None and mtime == self._mtime:
+            return
+        if mtime is None:
+            policy = default_policy()
+        else:
+            try:
+                with open(self.path, "r") as f:
+                    policy = json.load(f)
+            except (OSError, ValueError) as e:
+                # A broken edit keeps the previous policy in force
+                print(f"Error loading policy {self.path}: {e}")
+                if self._compiled is not None:
+                    self._mtime = mtime
+                    return
+                policy = {"default": "deny"}
+        self._compiled = CompiledPolicy(policy)
+        self._mtime = mtime
+
+    def current(self):
+        now = time.monotonic()
+        if self._compiled is None or now - self._checked >= RELOAD_INTERVAL:
+            with self._lock:
+                if self._compiled is None or now - self._checked >= RELOAD_INTERVAL:
+                    self._load()
+                    self._checked = now
+        return self._compiled
+
+    def allowed(self, addr, action, product=None):
+        return self.current().allowed(addr, action, product)
+
+    def allowed_any(self, addr, action):
+        return self.current().allowed_any(addr, action)
+
+policy = PolicyEngine()
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Products kept per consumer, the least recently consumed ones are evicted first
+PRODUCT_CACHE_SIZE = 1024
+# Entries older than this are dropped and the product is fetched in full again
+PRODUCT_CACHE_TTL = 300.0
+
+class ProductCache:
+    # Decoded products by (domain, product name) with the etag of the payload they were decoded
+    # from. Callers get the cached object itself and must not change it
+    def __init__(self, max_size=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, domain, name):
+        # (etag, product), or None when missing or expired
+        key = (domain, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            etag, product, stored = entry
+            if time.monotonic() - stored >= self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return etag, product
+
+    def put(self, domain, name, etag, product):
+        if self.max_size <= 0:
+            return
+        key = (domain, name)
+        with self._lock:
+            self._entries[key] = (etag, product, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def refresh(self, domain, name):
+        # The domain confirmed the cached product is current, so its TTL starts over
+        key = (domain, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], time.monotonic())
+                self._entries.move_to_end(key)
+
+    def discard(self, domain, name):
+        with self._lock:
+            self._entries.pop((domain, name), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+product_cache = ProductCache()
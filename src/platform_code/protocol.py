@@ -0,0 +1,175 @@
+import asyncio
+import struct
+
+from config import MAX_MESSAGE_SIZE
+
+# Every message is a header (type length, payload length), the type and the payload
+HEADER = struct.Struct("!HQ")
+CHUNK_SIZE = 64 * 1024
+# Message types are short names, a longer one is a broken or hostile peer
+MAX_TYPE_LENGTH = 64
+
+def _recv_exact(sock, size, allow_eof=False):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], min(size - received, CHUNK_SIZE))
+        if count == 0:
+            if allow_eof and received == 0:
+                return None
+            raise ConnectionError("Connection closed in the middle of a message")
+        received += count
+    return buffer
+
+def _decode_type(type_bytes):
+    try:
+        return type_bytes.decode()
+    except UnicodeDecodeError:
+        raise ConnectionError("Message type is not valid UTF-8")
+
+def _check_header(type_length, payload_length, max_size):
+    # The header comes from the peer, so nothing is allocated for it before it is checked
+    if type_length > MAX_TYPE_LENGTH:
+        raise ConnectionError(f"Message type of {type_length} bytes is longer than {MAX_TYPE_LENGTH}")
+    if max_size is not None and payload_length > max_size:
+        raise ConnectionError(f"Message of {payload_length} bytes is larger than {max_size}")
+
+def send_header(sock, message_type, length):
+    type_bytes = message_type.encode()
+    sock.sendall(HEADER.pack(len(type_bytes), length) + type_bytes)
+
+def send_message(sock, message_type, payload=b""):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    type_bytes = message_type.encode()
+    header = HEADER.pack(len(type_bytes), len(payload)) + type_bytes
+
+    # Small messages go out in a single write, large ones are streamed in chunks
+    if len(payload) <= CHUNK_SIZE:
+        sock.sendall(header + payload)
+        return
+    sock.sendall(header)
+    view = memoryview(payload)
+    for start in range(0, len(view), CHUNK_SIZE):
+        sock.sendall(view[start:start + CHUNK_SIZE])
+
+def send_stream(sock, message_type, length, chunks):
+    send_header(sock, message_type, length)
+    sent = 0
+    for chunk in chunks:
+        sock.sendall(chunk)
+        sent += len(chunk)
+    if sent != length:
+        raise ValueError(f"Stream announced {length} bytes but sent {sent}")
+
+def send_file(sock, message_type, file, offset, count):
+    # The kernel copies the file straight to the socket where the platform supports it
+    send_header(sock, message_type, count)
+    if count > 0:
+        sock.sendfile(file, offset, count)
+
+def recv_header(sock):
+    header = _recv_exact(sock, HEADER.size, allow_eof=True)
+    if header is None:
+        return None, 0
+    type_length, payload_length = HEADER.unpack(header)
+    _check_header(type_length, payload_length, None)
+    message_type = _decode_type(_recv_exact(sock, type_length))
+    return message_type, payload_length
+
+def recv_stream(sock, length):
+    remaining = length
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed in the middle of a message")
+        remaining -= len(chunk)
+        yield chunk
+
+class MessageReader:
+    # Assembles one message from whatever pieces of it have arrived, so one thread can read many
+    # connections. Each feed reads at most one chunk and never past the end of the message
+    def __init__(self, max_size=MAX_MESSAGE_SIZE):
+        self.max_size = max_size
+        # (type length, payload length) once the header is complete
+        self._header = None
+        self._buffer = bytearray()
+
+    @property
+    def started(self):
+        return self._header is not None or bool(self._buffer)
+
+    def feed(self, sock):
+        # (type, payload) once the message is complete, None while more of it is needed
+        needed = HEADER.size if self._header is None else sum(self._header)
+        chunk = sock.recv(min(needed - len(self._buffer), CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed in the middle of a message" if self.started else "Connection closed")
+        self._buffer += chunk
+        if len(self._buffer) < needed:
+            return None
+        if self._header is None:
+            type_length, payload_length = HEADER.unpack(self._buffer)
+            _check_header(type_length, payload_length, self.max_size)
+            self._header = (type_length, payload_length)
+            self._buffer = bytearray()
+            if type_length + payload_length > 0:
+                return None
+        payload, type_length = self._buffer, self._header[0]
+        message_type = _decode_type(bytes(payload[:type_length]))
+        del payload[:type_length]
+        self._header = None
+        self._buffer = bytearray()
+        return message_type, payload
+
+def recv_message(sock, max_size=MAX_MESSAGE_SIZE):
+    # Streamed payloads are read with recv_header and recv_stream, whole messages are bounded
+    message_type, length = recv_header(sock)
+    if message_type is None:
+        return None, b""
+    _check_header(0, length, max_size)
+    return message_type, _recv_exact(sock, length)
+
+'''
+Asyncio streams
+=========================
+'''
+async def read_message(reader, max_size=MAX_MESSAGE_SIZE):
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None, b""
+        raise ConnectionError("Connection closed in the middle of a message")
+    type_length, payload_length = HEADER.unpack(header)
+    _check_header(type_length, payload_length, max_size)
+    try:
+        message_type = _decode_type(await reader.readexactly(type_length))
+        payload = await reader.readexactly(payload_length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in the middle of a message")
+    return message_type, payload
+
+async def write_message(writer, message_type, payload=b""):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    type_bytes = message_type.encode()
+    header = HEADER.pack(len(type_bytes), len(payload)) + type_bytes
+
+    if len(payload) <= CHUNK_SIZE:
+        writer.write(header + payload)
+    else:
+        writer.write(header)
+        view = memoryview(payload)
+        for start in range(0, len(view), CHUNK_SIZE):
+            writer.write(view[start:start + CHUNK_SIZE])
+            await writer.drain()
+    await writer.drain()
+
+async def write_file(writer, message_type, file, offset, count):
+    type_bytes = message_type.encode()
+    writer.write(HEADER.pack(len(type_bytes), count) + type_bytes)
+    await writer.drain()
+    if count > 0:
+        await asyncio.get_running_loop().sendfile(writer.transport, file, offset, count)
@@ -0,0 +1,426 @@
+import bisect
+import fnmatch
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+# Number of changes kept to answer delta discovery, older clients get the full catalog
+CHANGE_LOG_SIZE = 10_000
+# Subscribers that fall this many events behind are dropped and have to resubscribe
+SUBSCRIPTION_QUEUE_SIZE = 10_000
+# Page size of discovery queries, and the most a client can ask for
+QUERY_LIMIT = 100
+QUERY_MAX_LIMIT = 1_000
+
+class Subscription:
+    def __init__(self, max_pending=SUBSCRIPTION_QUEUE_SIZE):
+        self.events = queue.Queue(maxsize=max_pending)
+        self.overflowed = False
+
+    def push(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+class MarketplaceRegistry:
+    def __init__(self, path="src/platform_code/marketplace.json", flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._marketplace = {}
+        self._epoch = None
+        self._version = 0
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)
+        self._discover_payload = None
+        # Indexes for discovery queries: sorted (product, domain) pairs, pairs per tag, tags per pair
+        self._sorted = []
+        self._by_tag = {}
+        self._tags = {}
+        self._subscribers = []
+        # Set on read replicas, which only change through replicate()
+        self.primary = None
+        # Set in pre-forked workers, writes run on the writing process (shared_registry.WriterChannel)
+        self.writer = None
+        self._dirty = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+
+    def reset(self, platform_ip):
+        with self._lock:
+            self._marketplace = {
+                "platform": {
+                    "domain": platform_ip,
+                    "products": []
+                }
+            }
+            self._new_epoch()
+            self._rebuild_indexes()
+            self._dirty.set()
+
+    def load(self):
+        with open(self.path, "r") as f:
+            marketplace = json.load(f)
+        with self._lock:
+            self._marketplace = marketplace
+            self._new_epoch()
+            self._rebuild_indexes()
+
+    def _new_epoch(self):
+        # Versions are only comparable within an epoch, a restarted platform starts a new one
+        self._epoch = str(time.time_ns())
+        self._version = 0
+        self._changes.clear()
+        self._discover_payload = None
+
+    '''
+    Query indexes
+    =========================
+    '''
+    def _rebuild_indexes(self):
+        # Caller holds the lock
+        self._sorted = []
+        self._by_tag = {}
+        self._tags = {}
+        for data_product_name, addr in self._product_domain_pairs():
+            self._index(data_product_name, addr)
+
+    def _index(self, data_product_name, addr):
+        # Caller holds the lock, tags are read from the marketplace entry of the domain
+        pair = (data_product_name, addr)
+        tags = tuple(self._marketplace[addr].get("tags", {}).get(data_product_name, ()))
+        if pair in self._tags:
+            self._unindex_tags(pair)
+        else:
+            bisect.insort(self._sorted, pair)
+        self._tags[pair] = tags
+        for tag in tags:
+            self._by_tag.setdefault(tag, set()).add(pair)
+
+    def _unindex(self, data_product_name, addr):
+        # Caller holds the lock
+        pair = (data_product_name, addr)
+        if pair not in self._tags:
+            return
+        self._unindex_tags(pair)
+        del self._tags[pair]
+        del self._sorted[bisect.bisect_left(self._sorted, pair)]
+
+    def _unindex_tags(self, pair):
+        for tag in self._tags[pair]:
+            pairs = self._by_tag[tag]
+            pairs.discard(pair)
+            if not pairs:
+                del self._by_tag[tag]
+
+    def _tagged(self, pairs):
+        # Caller holds the lock, tags travel with the catalog so replicas can answer queries
+        return [[*pair, list(self._tags[pair])] for pair in pairs if self._tags.get(pair)]
+
+    def _changed(self, change, data_product_name, addr, version=None):
+        self._apply_changes([(change, data_product_name, addr)], version)
+
+    def _apply_changes(self, changes, version=None):
+        # Caller holds the lock and already updated the marketplace entries. A batch of changes
+        # shares one version and one subscription event, so readers never see half of it
+        if not changes:
+            return
+        self._version = self._version + 1 if version is None else version
+        added = []
+        removed = []
+        for change, data_product_name, addr in changes:
+            self._changes.append((self._version, change, data_product_name, addr))
+            if change == "add":
+                self._index(data_product_name, addr)
+                added.append((data_product_name, addr))
+            else:
+                self._marketplace.get(addr, {}).get("tags", {}).pop(data_product_name, None)
+                self._unindex(data_product_name, addr)
+                removed.append((data_product_name, addr))
+        self._discover_payload = None
+        self._dirty.set()
+
+        if self._subscribers:
+            event = json.dumps({
+                "version": f"{self._epoch}:{self._version}",
+                "added": added,
+                "removed": removed,
+                "tags": self._tagged(added),
+            }).encode()
+            for push in self._subscribers:
+                push(event)
+
+    def version(self):
+        with self._lock:
+            return f"{self._epoch}:{self._version}"
+
+    # Read without the lock for gauges, a value may be one change behind
+    def product_count(self):
+        return len(self._sorted)
+
+    def domain_count(self):
+        return sum(1 for addr in list(self._marketplace) if addr != "platform")
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def platform_ip(self):
+        with self._lock:
+            return self._marketplace["platform"]["domain"]
+
+    def add_domain(self, addr):
+        if self.writer is not None:
+            return self.writer.request("add_domain", addr)
+        with self._lock:
+            if addr in self._marketplace:
+                # A known domain saying hello again has restarted, its old products are withdrawn
+                products = self._marketplace[addr]["products"]
+                self._apply_changes([("remove", data_product_name, addr) for data_product_name in products])
+                products.clear()
+                return False
+            self._marketplace[addr] = {
+                "domain": addr,
+                "products": []
+            }
+            self._dirty.set()
+            return True
+
+    def register_product(self, addr, data_product_name, tags=()):
+        if self.writer is not None:
+            return self.writer.request("register_product", addr, data_product_name, list(tags))
+        with self._lock:
+            if addr not in self._marketplace:
+                return False
+            products = self._marketplace[addr]["products"]
+            if self._set_tags(addr, data_product_name, tags) or data_product_name not in products:
+                if data_product_name not in products:
+                    products.append(data_product_name)
+                self._changed("add", data_product_name, addr)
+            return True
+
+    def join_domain(self, addr, products=()):
+        # Hello and bulk registration in one step: the domain ends up with exactly these products,
+        # given as {"name", "tags"} descriptors, applied as a single change
+        if self.writer is not None:
+            return self.writer.request("join_domain", addr, list(products))
+        tags = {product["name"]: product.get("tags") or [] for product in products}
+        with self._lock:
+            known = addr in self._marketplace
+            domain = self._marketplace.setdefault(addr, {"domain": addr, "products": []})
+            current = set(domain["products"])
+            changes = [("remove", data_product_name, addr) for data_product_name in current if data_product_name not in tags]
+            for data_product_name, product_tags in tags.items():
+                if self._set_tags(addr, data_product_name, product_tags) or data_product_name not in current:
+                    changes.append(("add", data_product_name, addr))
+            domain["products"] = [name for name in domain["products"] if name in tags]
+            domain["products"] += [name for name in tags if name not in current]
+            self._apply_changes(changes)
+            self._dirty.set()
+            return not known
+
+    def _set_tags(self, addr, data_product_name, tags):
+        # Caller holds the lock, returns whether the tags of the product changed
+        tags = sorted(set(tags))
+        domain_tags = self._marketplace[addr].setdefault("tags", {})
+        if domain_tags.get(data_product_name, []) == tags:
+            return False
+        if tags:
+            domain_tags[data_product_name] = tags
+        else:
+            domain_tags.pop(data_product_name, None)
+        return True
+
+    def _product_domain_pairs(self):
+        return [
+            (product, domain)
+            for domain in self._marketplace if domain != "platform"
+            for product in self._marketplace[domain]["products"]
+        ]
+
+    def product_domain_pairs(self):
+        with self._lock:
+            return self._product_domain_pairs()
+
+    def discover_payload(self):
+        # The encoded catalog is cached until the next mutation
+        with self._lock:
+            if self._discover_payload is None:
+                products = self._product_domain_pairs()
+                self._discover_payload = json.dumps({
+                    "version": f"{self._epoch}:{self._version}",
+                    "products": products,
+                    "tags": self._tagged(products),
+                }).encode()
+            return self._discover_payload
+
+    def _changes_since(self, known_version):
+        # Caller holds the lock, returns None when the change log does not reach back far enough.
+        # Batches share a version, so the log is only complete when it still holds an older one
+        if not self._changes or self._changes[0][0] > known_version:
+            return None
+        net_changes = {}
+        for version, change, data_product_name, addr in self._changes:
+            if version <= known_version:
+                continue
+            # The last change wins, removing an unknown or adding a known pair is harmless
+            net_changes[data_product_name, addr] = change
+        added = [pair for pair, change in net_changes.items() if change == "add"]
+        return {
+            "added": added,
+            "removed": [pair for pair, change in net_changes.items() if change == "remove"],
+            "tags": self._tagged(added),
+        }
+
+    def discover_response(self, known_version=""):
+        epoch, _, version = known_version.partition(":")
+        with self._lock:
+            if epoch == self._epoch and version.isdigit():
+                version = int(version)
+                if version == self._version:
+                    return "not_modified", b""
+                if version < self._version:
+                    delta = self._changes_since(version)
+                    if delta is not None:
+                        delta["version"] = f"{self._epoch}:{self._version}"
+                        return "delta", json.dumps(delta).encode()
+        return "ok", self.discover_payload()
+
+    def replicate(self, response, payload):
+        # Applies the primary's subscription stream. Versions are the primary's, so clients can
+        # switch between the primary and its replicas without losing conditional discovery
+        if response == "not_modified":
+            return
+        catalog = json.loads(payload)
+        epoch, _, version = catalog["version"].partition(":")
+        version = int(version)
+        tags = {(data_product_name, addr): tags for data_product_name, addr, tags in catalog.get("tags", [])}
+        with self._lock:
+            if response == "ok":
+                # Every product is applied again, only new products and changed tags count as changes
+                added = [tuple(pair) for pair in catalog["products"]]
+                removed = set(self._product_domain_pairs()) - set(added)
+            else:
+                added = [tuple(pair) for pair in catalog["added"]]
+                removed = [tuple(pair) for pair in catalog["removed"]]
+            if epoch != self._epoch:
+                self._epoch = epoch
+                self._changes.clear()
+            elif version > self._version + 1:
+                # Versions were skipped, by a coalesced publish or a missed stream. Their changes are
+                # not known one by one, so clients that saw one of them get the full catalog
+                self._changes.clear()
+
+            # Membership is checked on the pair index, the domains' product lists are rebuilt once
+            removed = [pair for pair in removed if pair in self._tags]
+            removed_by_domain = {}
+            for data_product_name, addr in removed:
+                removed_by_domain.setdefault(addr, set()).add(data_product_name)
+            for addr, names in removed_by_domain.items():
+                domain = self._marketplace[addr]
+                domain["products"] = [name for name in domain["products"] if name not in names]
+            changes = [("remove", data_product_name, addr) for data_product_name, addr in removed]
+            for data_product_name, addr in added:
+                domain = self._marketplace.setdefault(addr, {"domain": addr, "products": []})
+                changed_tags = self._set_tags(addr, data_product_name, tags.get((data_product_name, addr), []))
+                if (data_product_name, addr) not in self._tags:
+                    domain["products"].append(data_product_name)
+                    changes.append(("add", data_product_name, addr))
+                elif changed_tags:
+                    changes.append(("add", data_product_name, addr))
+            self._apply_changes(changes, version)
+            self._version = version
+            self._discover_payload = None
+
+    def query(self, prefix="", pattern=None, domains=None, exclude_domains=None, tags=None,
+              limit=QUERY_LIMIT, cursor=None):
+        # Pages through (product, domain) pairs in sorted order, the cursor is the last pair returned
+        limit = min(max(int(limit), 1), QUERY_MAX_LIMIT)
+        domains = set(domains) if domains else None
+        exclude_domains = set(exclude_domains or ())
+        with self._lock:
+            # Start from the smallest index that covers the query
+            if tags:
+                tagged = sorted((self._by_tag.get(tag, set()) for tag in tags), key=len)
+                candidates = sorted(tagged[0].intersection(*tagged[1:]))
+            elif domains is not None:
+                candidates = sorted(
+                    (data_product_name, addr)
+                    for addr in domains if addr != "platform" and addr in self._marketplace
+                    for data_product_name in self._marketplace[addr]["products"]
+                )
+            else:
+                candidates = self._sorted
+
+            index = bisect.bisect_left(candidates, (prefix, ""))
+            if cursor:
+                index = max(index, bisect.bisect_right(candidates, tuple(cursor)))
+            products = []
+            more = False
+            # Indexed instead of sliced, so a page does not copy the rest of the index
+            for position in range(index, len(candidates)):
+                data_product_name, addr = candidates[position]
+                if not data_product_name.startswith(prefix):
+                    break
+                if domains is not None and addr not in domains or addr in exclude_domains:
+                    continue
+                if pattern is not None and not fnmatch.fnmatchcase(data_product_name, pattern):
+                    continue
+                if len(products) == limit:
+                    more = True
+                    break
+                products.append([data_product_name, addr, list(self._tags[data_product_name, addr])])
+            return {
+                "version": f"{self._epoch}:{self._version}",
+                "products": products,
+                "cursor": products[-1][:2] if more else None,
+            }
+
+    def subscribe(self, push, known_version=""):
+        # Registering and answering the known version under one lock means no change is missed
+        with self._lock:
+            self._subscribers.append(push)
+            return self.discover_response(known_version)
+
+    def unsubscribe(self, push):
+        with self._lock:
+            if push in self._subscribers:
+                self._subscribers.remove(push)
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._marketplace))
+
+    '''
+    Write-behind persistence
+    =========================
+    '''
+    def flush(self):
+        self._dirty.clear()
+        marketplace = self.snapshot()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(marketplace, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def _flush_loop(self):
+        while not self._stopped.is_set():
+            if self._dirty.wait(timeout=self.flush_interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Error flushing marketplace: {e}")
+                self._stopped.wait(self.flush_interval)
+
+    def start(self):
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        if self._dirty.is_set():
+            self.flush()
@@ -0,0 +1,61 @@
+import bisect
+import hashlib
+import json
+import os
+import random
+
+# Points per node on the ring, more points spread keys more evenly
+VIRTUAL_NODES = 64
+
+LOCAL_DB_PATH = "src/platform_code/local_db.json"
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        points = sorted((_hash(f"{node}#{index}"), node) for node in self.nodes for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        # Adding or removing a node only moves the keys next to its points
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+class ShardMap:
+    # The marketplace is partitioned over the primaries by product name, every primary can
+    # have read replicas that serve discovery for its partition
+    def __init__(self, shards, replicas=None):
+        self.shards = list(shards)
+        self.replicas = {shard: list((replicas or {}).get(shard, [])) for shard in self.shards}
+        self._ring = HashRing(self.shards)
+
+    def shard_for_product(self, product_name):
+        return self._ring.node_for(product_name)
+
+    def read_nodes(self, shard):
+        # Primary and replicas in random order, so reads spread and the next node is the fallback
+        nodes = [shard] + self.replicas[shard]
+        random.shuffle(nodes)
+        return nodes
+
+    def all_nodes(self):
+        return [node for shard in self.shards for node in [shard] + self.replicas[shard]]
+
+_cached = (None, None)
+
+def shard_map(path=LOCAL_DB_PATH):
+    # Reloaded when the local database changes
+    global _cached
+    mtime = os.stat(path).st_mtime_ns
+    cached_mtime, cached_map = _cached
+    if cached_mtime == mtime:
+        return cached_map
+    with open(path, "r") as f:
+        platform = json.load(f)["platform"]
+    shards = platform.get("shards") or [platform["domain"]]
+    cached_map = ShardMap(shards, platform.get("replicas"))
+    _cached = (mtime, cached_map)
+    return cached_map
@@ -0,0 +1,152 @@
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+# Shared memory is only backed by pages once written, so the reservation is cheap
+SHARED_CATALOG_SIZE = 256 * 1024 * 1024
+# How often workers check the catalog for a newer version
+FOLLOW_INTERVAL = 0.01
+
+# Sequence number and payload length, the sequence is odd while the writer is publishing
+_HEADER = struct.Struct("!QQ")
+
+# Registry methods workers may run on the writing process
+WRITE_METHODS = ("add_domain", "join_domain", "register_product")
+
+class SharedCatalog:
+    # Single writer, many readers. Readers retry when the sequence changed or was odd while
+    # they copied the payload (a seqlock), so they never block the writer
+    def __init__(self, size=SHARED_CATALOG_SIZE):
+        self._memory = shared_memory.SharedMemory(create=True, size=size)
+        self._buffer = self._memory.buf
+        self._sequence = 0
+        _HEADER.pack_into(self._buffer, 0, 0, 0)
+
+    def publish(self, payload):
+        if _HEADER.size + len(payload) > len(self._buffer):
+            raise ValueError(f"Catalog of {len(payload)} bytes does not fit in shared memory")
+        self._sequence += 1
+        _HEADER.pack_into(self._buffer, 0, self._sequence, 0)
+        self._buffer[_HEADER.size:_HEADER.size + len(payload)] = payload
+        self._sequence += 1
+        _HEADER.pack_into(self._buffer, 0, self._sequence, len(payload))
+
+    def sequence(self):
+        return _HEADER.unpack_from(self._buffer, 0)[0]
+
+    def read(self):
+        while True:
+            sequence, length = _HEADER.unpack_from(self._buffer, 0)
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            payload = bytes(self._buffer[_HEADER.size:_HEADER.size + length])
+            if _HEADER.unpack_from(self._buffer, 0)[0] == sequence:
+                return sequence, payload
+
+    def close(self):
+        self._buffer.release()
+        self._memory.close()
+        self._memory.unlink()
+
+'''
+Writing process
+=========================
+'''
+class CatalogPublisher:
+    def __init__(self, registry, catalog):
+        self.registry = registry
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._published = None
+
+    def publish(self):
+        # Concurrent writes are coalesced, whoever gets the lock publishes the newest catalog
+        with self._lock:
+            version = self.registry.version()
+            if version != self._published:
+                self.catalog.publish(self.registry.discover_payload())
+                self._published = version
+
+    def _publish_loop(self):
+        # Picks up changes that do not come from workers, like replication from a primary
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                print(f"Error publishing the shared catalog: {e}")
+            time.sleep(FOLLOW_INTERVAL)
+
+    def _serve(self, connection):
+        while True:
+            try:
+                method, args = connection.recv()
+            except EOFError:
+                return
+            try:
+                if method not in WRITE_METHODS:
+                    raise ValueError(f"Unknown registry method: {method}")
+                # A replica only takes the primary's changes
+                if self.registry.primary is not None:
+                    raise ValueError(f"Read-only replica of {self.registry.primary}")
+                result = getattr(self.registry, method)(*args)
+                self.publish()
+            except Exception as e:
+                print(f"Error applying {method} from a worker: {e}")
+                result = False
+            connection.send(result)
+
+    def serve(self, connections):
+        self.publish()
+        threading.Thread(target=self._publish_loop, daemon=True).start()
+        for connection in connections:
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+'''
+Worker processes
+=========================
+'''
+class WriterChannel:
+    # Runs registry writes on the writing process and waits until they are published
+    def __init__(self, connection, follower):
+        self.connection = connection
+        self.follower = follower
+        self._lock = threading.Lock()
+
+    def request(self, method, *args):
+        with self._lock:
+            self.connection.send((method, args))
+            result = self.connection.recv()
+        # Read your writes: this worker sees the change before answering the domain
+        self.follower.sync()
+        return result
+
+class CatalogFollower:
+    def __init__(self, registry, catalog):
+        self.registry = registry
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._sequence = None
+
+    def sync(self):
+        if self.catalog.sequence() == self._sequence:
+            return
+        with self._lock:
+            sequence, payload = self.catalog.read()
+            if sequence != self._sequence and payload:
+                self.registry.replicate("ok", payload)
+                self._sequence = sequence
+
+    def _follow_loop(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Error following the shared catalog: {e}")
+            time.sleep(FOLLOW_INTERVAL)
+
+    def start(self):
+        self.sync()
+        threading.Thread(target=self._follow_loop, daemon=True).start()
+        return self
@@ -0,0 +1,77 @@
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+from config import TOKEN_SECRET
+
+TOKEN_TTL = 30
+# Consumers fetch a new token when the cached one is about to expire
+TOKEN_REFRESH_MARGIN = 5
+VERIFIED_CACHE_SIZE = 4096
+
+def _sign(message):
+    if not TOKEN_SECRET:
+        raise RuntimeError("No token signing secret, set the DATA_MESH_TOKEN_SECRET environment variable")
+    return hmac.new(TOKEN_SECRET.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+'''
+Functions used by the platform
+=========================
+'''
+def issue_token(domain, action, ttl=TOKEN_TTL):
+    expiry = int(time.time()) + ttl
+    message = f"{action}/{domain}/{expiry}"
+    return f"{message}/{_sign(message)}"
+
+'''
+Functions used by the domains
+=========================
+'''
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+def verify_token(token, action, domain):
+    if not token:
+        return False
+    now = time.time()
+
+    with _verified_lock:
+        cached = _verified.get(token)
+        if cached is not None:
+            _verified.move_to_end(token)
+    if cached is not None:
+        cached_action, cached_domain, expiry = cached
+        return cached_action == action and cached_domain == domain and now < expiry
+
+    try:
+        token_action, token_domain, expiry, signature = token.split("/")
+        expiry = int(expiry)
+    except ValueError:
+        return False
+    if not hmac.compare_digest(signature, _sign(f"{token_action}/{token_domain}/{expiry}")):
+        return False
+    if now >= expiry:
+        return False
+
+    with _verified_lock:
+        _verified[token] = (token_action, token_domain, expiry)
+        if len(_verified) > VERIFIED_CACHE_SIZE:
+            _verified.popitem(last=False)
+    return token_action == action and token_domain == domain
+
+_issued = {}
+_issued_lock = threading.Lock()
+
+def cached_token(action):
+    with _issued_lock:
+        token, expiry = _issued.get(action, (None, 0))
+    if time.time() < expiry - TOKEN_REFRESH_MARGIN:
+        return token
+    return None
+
+def store_token(action, token):
+    expiry = int(token.split("/")[2])
+    with _issued_lock:
+        _issued[action] = (token, expiry)